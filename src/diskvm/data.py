@@ -1,4 +1,6 @@
 import dataclasses
+import os
+import stat
 from contextlib import ExitStack
 from enum import Enum
 from pathlib import Path
@@ -7,11 +9,13 @@ from typing import Optional, Any
 from pyreadpartitions import get_disk_partitions_info
 
 import diskvm
-from diskvm.utils import SizeUnit
+from diskvm import partition_fast
+from diskvm.errors import UnsupportedPartitionTableError
+from diskvm.utils import SizeUnit, MountPointPool
 from diskvm.vm.base import VirtualMachineBuilder, VirtualMachine, FirmwareType
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class DiskVmCreatorOptions:
     """
     Directory to write all VM configuration files.
@@ -53,6 +57,12 @@ class DiskVmCreatorOptions:
 
     start_vm: bool = True
 
+    """
+    Set up loop devices for partitions with direct I/O to not cache disk image contents twice.
+    Falls back to buffered I/O if not supported.
+    """
+    loop_direct_io: bool = True
+
     """
     Additional options that may be required by plugins.
     """
@@ -63,7 +73,7 @@ class DiskVmCreatorOptions:
         return [self.disk_image] + self.additional_disk_images
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class VolumeInfo:
     disk_info: 'DiskInfo' = dataclasses.field(repr=False)
     flat_mount: Optional[Path] = dataclasses.field(default=None, repr=True)
@@ -74,6 +84,12 @@ class VolumeInfo:
     volume_type: Optional[Any] = dataclasses.field(default=None, repr=False)
     volume_info: Optional[Any] = dataclasses.field(default=None, repr=False)
     additional_info: dict = dataclasses.field(default_factory=dict, repr=False)
+    # Number of parent volumes. Partitions have depth 0
+    depth: int = dataclasses.field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.parent is not None:
+            self.depth = self.parent.depth + 1
 
 
 class PartitionScheme(Enum):
@@ -82,14 +98,27 @@ class PartitionScheme(Enum):
     UNKNOWN = 'unknown'
 
 
-@dataclasses.dataclass()
+# MBR, GPT header and 128 GPT partition entries
+PARTITION_TABLE_SIZE = 34 * 512
+
+
+@dataclasses.dataclass(slots=True)
 class DiskInfo:
     readonly: bool = dataclasses.field(repr=True)
     flat_mounted_disk: Path = dataclasses.field(repr=True)
-    disk_info: Any = dataclasses.field(init=False, repr=False)
     volumes: list[VolumeInfo] = dataclasses.field(default_factory=list, repr=False)
     additional_info: dict = dataclasses.field(default_factory=dict, repr=False)
     keep_mounted: bool = dataclasses.field(default=False, repr=False)
+    _disk_info_cache: Any = dataclasses.field(default=None, init=False, repr=False)
+
+    @property
+    def disk_info(self) -> Any:
+        """
+        Partition table information. Parsed on first access.
+        """
+        if self._disk_info_cache is None:
+            self._disk_info_cache = self._read_disk_info()
+        return self._disk_info_cache
 
     @property
     def partition_scheme(self) -> PartitionScheme:
@@ -109,20 +138,38 @@ class DiskInfo:
         else:
             return 512
 
-    def refresh_disk_info(self):
+    def _read_disk_info(self):
+        fd = os.open(self.flat_mounted_disk, os.O_RDONLY)
+        try:
+            # Block devices might use other sector sizes than 512 bytes
+            if not stat.S_ISBLK(os.fstat(fd).st_mode):
+                try:
+                    return partition_fast.parse_partition_table(os.pread(fd, PARTITION_TABLE_SIZE, 0))
+                except UnsupportedPartitionTableError:
+                    # Extended partitions and large GPT partition arrays are not contained in the head
+                    pass
+        finally:
+            os.close(fd)
+
         with open(self.flat_mounted_disk, 'rb') as f:
-            self.disk_info = get_disk_partitions_info(f)
+            info = get_disk_partitions_info(f)
+            f.seek(0)
+            return partition_fast.add_fourth_mbr_partition(info, f.read(partition_fast.LBA_SIZE))
 
-    def __post_init__(self):
-        self.refresh_disk_info()
+    def refresh_disk_info(self):
+        """
+        Invalidate cached partition table information, e.g. after the disk was modified.
+        """
+        self._disk_info_cache = None
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class DiskVmCreatorContext:
     instance: 'diskvm.runner.DiskVmCreator' = dataclasses.field(repr=False)
     options: DiskVmCreatorOptions = dataclasses.field(repr=False)
     vm_builder: Optional[VirtualMachineBuilder] = dataclasses.field(default=None, repr=False)
     vm: Optional[VirtualMachine] = dataclasses.field(default=None, repr=False)
     mount_contexts: ExitStack = dataclasses.field(default_factory=ExitStack, repr=False)
+    mount_point_pool: MountPointPool = dataclasses.field(default_factory=MountPointPool, repr=False)
     additional_info: dict = dataclasses.field(default_factory=dict, repr=False)
 
@@ -19,3 +19,6 @@ class UnsupportedDiskTypeError(DiskVmError):
 class VirtualizationSoftwareNotAvailable(DiskVmError):
     pass
 
+
+class UnsupportedPartitionTableError(DiskVmError):
+    pass
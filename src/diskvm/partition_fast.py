@@ -0,0 +1,119 @@
+import logging
+import struct
+import uuid
+from collections import namedtuple
+from typing import Optional
+
+from diskvm.errors import UnsupportedPartitionTableError
+
+LBA_SIZE = 512
+MBR_SIGNATURE = b'\x55\xAA'
+MBR_PARTITION_TABLE_OFFSET = 446
+MBR_PARTITION = struct.Struct('<B3sB3sII')
+MBR_EXTENDED_TYPES = (0x05, 0x0F, 0x15, 0x1F, 0x85)
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct('<8sHHII4xQQQQ16sQIII')
+GPT_PARTITION = struct.Struct('<16s16sQQQ72s')
+
+# Same attributes as used from pyreadpartitions
+DiskPartitionsInfo = namedtuple('DiskPartitionsInfo', 'mbr, gpt')
+MbrInfo = namedtuple('MbrInfo', 'lba_size, partitions')
+MbrPartition = namedtuple('MbrPartition', 'index, status, type, lba, sectors')
+GptInfo = namedtuple('GptInfo', 'lba_size, disk_guid, first_usable_lba, last_usable_lba, partitions')
+GptPartition = namedtuple('GptPartition', 'index, guid, uid, first_lba, last_lba, flags, name')
+
+
+def parse_mbr(buf: bytes) -> Optional[MbrInfo]:
+    """
+    Parse the primary partitions of an MBR partition table.
+    :raise UnsupportedPartitionTableError for extended partitions (EBR chains are not contained in buf)
+    """
+    if len(buf) < LBA_SIZE or buf[510:512] != MBR_SIGNATURE:
+        return None
+
+    partitions = []
+    for index in range(1, 5):
+        if not (partition := _parse_mbr_partition(buf, index)):
+            continue
+        elif partition.type in MBR_EXTENDED_TYPES:
+            raise UnsupportedPartitionTableError('Extended MBR partition')
+        partitions.append(partition)
+    return MbrInfo(lba_size=LBA_SIZE, partitions=partitions)
+
+
+def _parse_mbr_partition(buf: bytes, index: int) -> Optional[MbrPartition]:
+    # index of primary partitions: 1-4
+    status, _, part_type, _, lba, sectors = MBR_PARTITION.unpack_from(buf, MBR_PARTITION_TABLE_OFFSET + (index - 1) * MBR_PARTITION.size)
+    if not part_type:
+        return None
+    return MbrPartition(index=index, status=status, type=part_type, lba=lba, sectors=sectors)
+
+
+def add_fourth_mbr_partition(info, buf: bytes):
+    """
+    pyreadpartitions only reads the first 3 primary MBR partition entries.
+    Add the 4th entry to its result, so that both parsers return the same partitions.
+    buf has to contain the MBR (LBA 0).
+    """
+    if not info.mbr or len(buf) < LBA_SIZE or buf[510:512] != MBR_SIGNATURE or \
+            any(p.index == 4 for p in info.mbr.partitions) or not (partition := _parse_mbr_partition(buf, 4)):
+        return info
+    if partition.type in MBR_EXTENDED_TYPES:
+        logging.warning('Logical partitions in the 4th MBR partition entry are not supported')
+
+    # Primary partitions (index 1-3) are followed by logical partitions (index 5+)
+    partitions = [p for p in info.mbr.partitions if p.index < 4] + [partition] + [p for p in info.mbr.partitions if p.index > 4]
+    return info._replace(mbr=info.mbr._replace(partitions=partitions))
+
+
+def parse_gpt(buf: bytes) -> Optional[GptInfo]:
+    """
+    Parse a GPT partition table. buf has to start at LBA 0.
+    :raise UnsupportedPartitionTableError if the partition entries are not contained in buf
+    """
+    if len(buf) < 2 * LBA_SIZE or buf[LBA_SIZE:LBA_SIZE + len(GPT_SIGNATURE)] != GPT_SIGNATURE:
+        return None
+
+    (_, revision_minor, revision_major, header_size, _, _, _, first_usable_lba, last_usable_lba, disk_guid,
+     part_entry_start_lba, num_part_entries, part_entry_size, _) = GPT_HEADER.unpack_from(buf, LBA_SIZE)
+    if revision_major < 1 or header_size < 92 or part_entry_size < GPT_PARTITION.size:
+        return None
+    if part_entry_start_lba * LBA_SIZE + num_part_entries * part_entry_size > len(buf):
+        raise UnsupportedPartitionTableError('GPT partition entries out of range')
+
+    partitions = []
+    for i in range(num_part_entries):
+        guid, uid, first_lba, last_lba, flags, name = GPT_PARTITION.unpack_from(buf, part_entry_start_lba * LBA_SIZE + i * part_entry_size)
+        if guid == b'\x00' * 16:
+            continue
+        partitions.append(GptPartition(
+            index=i + 1,
+            guid=str(uuid.UUID(bytes_le=guid)).upper(),
+            uid=str(uuid.UUID(bytes_le=uid)).upper(),
+            first_lba=first_lba,
+            last_lba=last_lba,
+            flags=flags,
+            name=name.decode('utf-16-le', errors='replace').split('\0', 1)[0],
+        ))
+    return GptInfo(
+        lba_size=LBA_SIZE,
+        disk_guid=str(uuid.UUID(bytes_le=disk_guid)).upper(),
+        first_usable_lba=first_usable_lba,
+        last_usable_lba=last_usable_lba,
+        partitions=partitions,
+    )
+
+
+def parse_partition_table(buf: bytes) -> DiskPartitionsInfo:
+    """
+    Parse MBR and GPT partition tables from the first sectors of a disk with 512 byte sectors.
+    :raise UnsupportedPartitionTableError if the partition table is not completely contained in buf
+    """
+    gpt = parse_gpt(buf)
+    try:
+        mbr = parse_mbr(buf)
+    except UnsupportedPartitionTableError:
+        if not gpt:
+            raise
+        mbr = None
+    return DiskPartitionsInfo(mbr=mbr, gpt=gpt)
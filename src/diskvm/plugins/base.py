@@ -1,4 +1,5 @@
 import logging
+import threading
 from pathlib import Path
 from typing import Optional, Union
 
@@ -67,27 +68,68 @@ class PluginSpec:
 
 
 class PluginManager:
+    HOOKS = tuple(name for name, value in vars(PluginSpec).items() if callable(value) and not name.startswith('_'))
+
     def __init__(self):
-        self.plugins = []
-        self.fallback_plugins = []
+        # Tuples: plugins have to be registered with add() and add_fallback(), which update the dispatch tables
+        self._plugins: tuple[PluginSpec, ...] = ()
+        self._fallback_plugins: tuple[PluginSpec, ...] = ()
+        self._all: tuple[PluginSpec, ...] = ()
+        self._dispatch: dict[str, list] = {}
+        # Plugins are not thread-safe and might modify the shared context: dispatch from one thread at a time
+        self._lock = threading.RLock()
+
+    @property
+    def plugins(self) -> tuple[PluginSpec, ...]:
+        return self._plugins
 
     @property
-    def all_plugins(self):
-        return self.plugins + self.fallback_plugins
+    def fallback_plugins(self) -> tuple[PluginSpec, ...]:
+        return self._fallback_plugins
+
+    @property
+    def all_plugins(self) -> tuple[PluginSpec, ...]:
+        return self._all
+
+    @staticmethod
+    def _overrides_hook(plugin: PluginSpec, name: str) -> bool:
+        # Hooks can be overridden in the plugin class or assigned on the instance
+        return getattr(getattr(plugin, name), '__func__', None) is not getattr(PluginSpec, name)
+
+    def _update_dispatch(self):
+        self._all = self._plugins + self._fallback_plugins
+        # Only dispatch to plugins that override the default hook implementation
+        self._dispatch = {
+            name: [getattr(p, name) for p in self._all if self._overrides_hook(p, name)]
+            for name in self.HOOKS
+        }
+
+    def _callbacks(self, name):
+        if (callbacks := self._dispatch.get(name)) is not None:
+            return callbacks
+        # Hooks not defined in PluginSpec
+        return [getattr(p, name) for p in self._all if hasattr(p, name)]
 
     def add(self, *plugins: PluginSpec):
-        self.plugins.extend(plugins)
+        self._plugins += plugins
+        self._update_dispatch()
+
+    def add_fallback(self, *plugins: PluginSpec):
+        self._fallback_plugins += plugins
+        self._update_dispatch()
 
     def dispatch_all(self, name, **kwargs):
-        logging.debug(f'Calling {name} with {kwargs}')
-        for p in self.all_plugins:
-            if cb := getattr(p, name):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(f'Calling {name} with {kwargs}')
+        with self._lock:
+            for cb in self._callbacks(name):
                 cb(**kwargs)
 
     def dispatch_until_result(self, name, **kwargs):
-        logging.debug(f'Calling {name} with {kwargs}')
-        for p in self.all_plugins:
-            if cb := getattr(p, name):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(f'Calling {name} with {kwargs}')
+        with self._lock:
+            for cb in self._callbacks(name):
                 if res := cb(**kwargs):
                     return res
         return None
@@ -1,5 +1,5 @@
-import contextlib
 import logging
+import os
 import re
 import struct
 import tempfile
@@ -7,13 +7,18 @@ from enum import IntEnum
 from pathlib import Path
 from typing import Optional, Union
 
+from diskvm.errors import DiskVmError
 from diskvm.plugins import utils
 from diskvm.plugins.base import PluginSpec
 from diskvm.data import VolumeInfo, DiskVmCreatorContext, DiskInfo
-from diskvm.utils import run_process, retry
+from diskvm.utils import run_process, retry, find_first, memory_file, stat_path
 from diskvm.vm.base import VirtualDiskBuilder, VirtualDiskPart
 
 BITLOCKER_SIGNATURE = b'-FVE-FS-'
+# Byte offsets of the 3 FVE metadata block copies in the volume header (Windows 7 and later)
+FVE_METADATA_OFFSETS_POS = 0xB0
+# Offset of the encryption type in the FVE metadata block
+FVE_METADATA_ENCRYPTION_TYPE_POS = 0x64
 
 
 class BitLockerMode(IntEnum):
@@ -25,14 +30,14 @@ class BitLockerMode(IntEnum):
     AES128_CBC_DIFFUSER = 0x8000
 
 
-@contextlib.contextmanager
+# Encryption types as printed by dislocker-metadata
+_MODE_BY_HEX = {f'0x{m.value:04x}': m for m in BitLockerMode}
+_DISLOCKER_ENCRYPTION_TYPE_PATTERN = re.compile(r'Encryption Type:.*\((0x[0-9a-fA-F]{4})\)', re.ASCII)
+
+
 def fvek_file(mode: BitLockerMode, key: bytes):
-    with tempfile.NamedTemporaryFile('wb') as f:
-        f.write(struct.pack('<H', mode.value))
-        # Pad key to 512 bit
-        f.write(key.ljust(64, b'\x00'))
-        f.flush()
-        yield f.name
+    # Pad key to 512 bit
+    return memory_file('fvek', struct.pack('<H', mode.value) + key.ljust(64, b'\x00'))
 
 
 def is_bitlocker(volume: VolumeInfo):
@@ -40,34 +45,42 @@ def is_bitlocker(volume: VolumeInfo):
 
 
 def unmount_bitlocker(mount_point: Union[Path, VolumeInfo]):
-    if isinstance(mount_point, Path) and mount_point.is_file():
+    parent_dev = None
+    mount_point_stat = stat_path(mount_point) if isinstance(mount_point, Path) else None
+    if mount_point_stat and mount_point_stat.is_file:
         mount_file = mount_point
-    elif isinstance(mount_point, Path) and mount_point.is_dir():
+    elif mount_point_stat and mount_point_stat.is_dir:
         mount_file = mount_point / 'dislocker-file'
     elif isinstance(mount_point, VolumeInfo) and mount_point.additional_info.get('bitlocker', {}).get('mounted') \
             and mount_point.flat_mount and mount_point.flat_mount.exists():
         mount_file = mount_point.flat_mount
+        parent_dev = mount_point.additional_info['bitlocker'].get('parent_dev')
     else:
         return False
 
+    # mkdtemp() re-uses names of removed mount directories
+    utils.invalidate_head(mount_file)
     mount_dir = mount_file.parent
-    if mount_dir.is_mount():
+    mount_dir_stat = stat_path(mount_dir, parent_dev=parent_dev)
+    if mount_dir_stat.is_mount:
         # Target might be busy from previous umount operations. Retry some time until umount succeeds
         @retry(10, sleep=0.5)
         def run_unmount():
             run_process(['umount', str(mount_dir)])
         run_unmount()
-    if mount_dir.is_dir():
+    if mount_dir_stat.is_dir:
         mount_dir.rmdir()
     return True
 
 
-def try_mount_bitlocker(volume: VolumeInfo, decrypt_args) -> Optional[VolumeInfo]:
+def try_mount_bitlocker(volume: VolumeInfo, decrypt_args, pass_fds=(), readonly=False) -> Optional[VolumeInfo]:
     mount_dir = Path(tempfile.mkdtemp())
     try:
+        # Device of the empty mount point directory, i.e. of the parent filesystem
+        parent_dev = os.stat(mount_dir).st_dev
         run_process(['dislocker-fuse', '--volume', str(volume.flat_mount),
-                     *(['--readonly'] if volume.disk_info.readonly else []),
-                     *decrypt_args, '--', str(mount_dir)])
+                     *(['--readonly'] if readonly or volume.disk_info.readonly else []),
+                     *decrypt_args, '--', str(mount_dir)], pass_fds=pass_fds)
         mount_file = mount_dir / 'dislocker-file'
 
         # Check if filesystem signature is NTFS
@@ -78,7 +91,7 @@ def try_mount_bitlocker(volume: VolumeInfo, decrypt_args) -> Optional[VolumeInfo
                 disk_info=volume.disk_info,
                 flat_mount=mount_file,
                 parent=volume,
-                additional_info={'bitlocker': {'mounted': True}}
+                additional_info={'bitlocker': {'mounted': True, 'parent_dev': parent_dev}}
             )
         else:
             unmount_bitlocker(mount_dir)
@@ -88,24 +101,60 @@ def try_mount_bitlocker(volume: VolumeInfo, decrypt_args) -> Optional[VolumeInfo
         return None
 
 
+def read_fve_mode(flat_mount: Path) -> Optional[BitLockerMode]:
+    """
+    Read the encryption mode from the FVE metadata block of a BitLocker volume
+    """
+    with open(flat_mount, 'rb') as f:
+        volume_header = f.read(512)
+        if len(volume_header) < 512 or volume_header[utils.BOOTCODE_LEN:utils.BOOTCODE_LEN + len(BITLOCKER_SIGNATURE)] != BITLOCKER_SIGNATURE:
+            return None
+
+        for metadata_offset in struct.unpack_from('<3Q', volume_header, FVE_METADATA_OFFSETS_POS):
+            f.seek(metadata_offset)
+            metadata_header = f.read(FVE_METADATA_ENCRYPTION_TYPE_POS + 2)
+            if len(metadata_header) == FVE_METADATA_ENCRYPTION_TYPE_POS + 2 and \
+                    metadata_header.startswith(BITLOCKER_SIGNATURE):
+                try:
+                    return BitLockerMode(struct.unpack_from('<H', metadata_header, FVE_METADATA_ENCRYPTION_TYPE_POS)[0])
+                except ValueError:
+                    pass
+    return None
+
+
 def find_correct_fvek(volume: VolumeInfo, ctx: DiskVmCreatorContext) -> Optional[tuple[BitLockerMode, bytes]]:
     master_keys = ctx.options.additional_options.get('master_keys', [])
     if not master_keys:
         return None
 
     # Read cipher mode from metadata
+    mode = None
     try:
-        metadata_info = run_process(['dislocker-metadata', '-V', str(volume.flat_mount)]).decode()
-        mode = BitLockerMode(int(re.search(r'Encryption Type:.*\((0x800[0-5])\)', metadata_info).group(1), 16))
-    except Exception:
-        return None
+        mode = read_fve_mode(volume.flat_mount)
+    except OSError:
+        pass
+    if mode is None:
+        # Fall back to dislocker for other metadata layouts (e.g. Windows Vista)
+        try:
+            metadata_info = run_process(['dislocker-metadata', '-V', str(volume.flat_mount)]).decode()
+        except DiskVmError:
+            logging.exception('Could not read BitLocker metadata')
+            return None
+        match = _DISLOCKER_ENCRYPTION_TYPE_PATTERN.search(metadata_info)
+        if not match or not (mode := _MODE_BY_HEX.get(match.group(1).lower())):
+            logging.warning(f'Unsupported BitLocker encryption type of {volume}')
+            return None
+
+    def try_key(key):
+        with fvek_file(mode=mode, key=key) as fvek:
+            # Trials only check the NTFS signature: never mount wrong FVEKs read-write
+            return try_mount_bitlocker(volume, ['--fvek', fvek.path], pass_fds=[fvek.fd], readonly=True)
 
     # Try all provided keys
-    for key in master_keys:
-        with fvek_file(mode=mode, key=key) as fvek_filename:
-            if mounted := try_mount_bitlocker(volume, ['--fvek', fvek_filename]):
-                unmount_bitlocker(mounted)
-                return mode, key
+    if found := find_first(try_key, master_keys, cleanup=unmount_bitlocker):
+        key, mounted = found
+        unmount_bitlocker(mounted)
+        return mode, key
     logging.warning(f'Could not find correct FVEK: {volume}')
     return None
 
@@ -128,9 +177,9 @@ class BitLockerMountPlugin(PluginSpec):
             return mounted
         elif fvek := find_correct_fvek(volume_info, ctx):
             logging.info(f'Found correct FVEK for BitLocker volume {fvek}')
-            with fvek_file(*fvek) as fvek_filename:
+            with fvek_file(*fvek) as f:
                 volume_info.additional_info['bitlocker']['fvek'] = fvek
-                return try_mount_bitlocker(volume_info, ['--fvek', fvek_filename])
+                return try_mount_bitlocker(volume_info, ['--fvek', f.path], pass_fds=[f.fd])
 
         return None
 
@@ -150,16 +199,16 @@ class BitLockerOverridePasswordPlugin(BitLockerMountPlugin):
 
         logging.info(f'Trying to modify the BitLocker header: add clear key and to override password {volume_info}')
         if fvek := find_correct_fvek(volume=volume_info, ctx=ctx):
-            with fvek_file(*fvek) as fvek_filename:
+            with fvek_file(*fvek) as f:
                 # Add clear key and default password
                 run_process(['dislocker-pwreset', '--volume', str(volume_info.flat_mount),
-                             '--fvek', fvek_filename,
+                             '--fvek', f.path,
                              '-vvvvvvvv'
-                             ])
-                volume_info.additional_info['bitlocker'] |= {
+                             ], pass_fds=[f.fd])
+                volume_info.additional_info['bitlocker'].update({
                     'clearkey': True,
                     'password': self.NEW_PASSWORD,
-                }
+                })
                 logging.info(f'Added BitLocker clear key and password "{self.NEW_PASSWORD}" {volume_info}')
 
 
@@ -1,12 +1,14 @@
 import logging
+import os
 import tempfile
 from pathlib import Path
 from typing import Optional, Union
 
 from diskvm.errors import DiskVmError
+from diskvm.plugins import utils
 from diskvm.plugins.base import PluginSpec
 from diskvm.data import VolumeInfo, DiskVmCreatorContext
-from diskvm.utils import run_process
+from diskvm.utils import run_process, stat_path
 
 
 class GenericMountPlugin(PluginSpec):
@@ -20,7 +22,10 @@ class GenericMountPlugin(PluginSpec):
     def mount(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> Optional[Union[Path, VolumeInfo, list[VolumeInfo]]]:
         fs_mount = Path(tempfile.mkdtemp())
         try:
+            # Device of the empty mount point directory, i.e. of the parent filesystem
+            parent_dev = os.stat(fs_mount).st_dev
             stdout, stderr = self.run_mount(volume_info, fs_mount)
+            volume_info.additional_info['mount'] = {'parent_dev': parent_dev}
 
             # # NOTE: after ntfsfix, Windows 10 cannot boot correctly (Recovery Screen, error code 0xc0000001)
             # #       on Windows 7, mount.ntfs fixes problems automatically on mount
@@ -37,22 +42,30 @@ class GenericMountPlugin(PluginSpec):
             return None
 
     def unmount_filesystem(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> bool:
-        if not volume_info.filesystem_mount.is_mount():
+        parent_dev = volume_info.additional_info.get('mount', {}).get('parent_dev')
+        if not stat_path(volume_info.filesystem_mount, parent_dev=parent_dev).is_mount:
             return False
 
         try:
+            # Mount points are directories
             run_process(['umount', str(volume_info.filesystem_mount)])
-            if volume_info.filesystem_mount.is_dir():
-                volume_info.filesystem_mount.rmdir()
+            volume_info.filesystem_mount.rmdir()
             return True
         except DiskVmError:
             logging.exception('Error while unmounting')
             return False
 
     def unmount_volume(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> bool:
-        if 'loop' in volume_info.flat_mount.name:
+        loop_info = volume_info.additional_info.get('loop', {})
+        if loop_info.get('partition_of'):
+            # Partition device of a disk loop device, removed when the disk loop device is detached
+            return True
+        # Loop device set up when mounting partitions
+        if loop_device := loop_info.get('device'):
             try:
-                run_process(['losetup', '--detach', str(volume_info.flat_mount)])
+                run_process(['losetup', '--detach', str(loop_device)])
+                # Loop device paths are re-used for other disk images
+                utils.invalidate_head(loop_device)
                 return True
             except DiskVmError:
                 pass
@@ -60,25 +73,59 @@ class GenericMountPlugin(PluginSpec):
 
 
 class LvmMountPlugin(PluginSpec):
-    @staticmethod
-    def _run_colon_output(args):
-        return [l.strip().split(':') for l in run_process(args).decode('utf-8').splitlines()]
-
-    @staticmethod
-    def list_physical_volumes() -> dict[Path, str]:
-        return {Path(pv[0]): pv[1] for pv in LvmMountPlugin._run_colon_output(['pvdisplay', '--colon'])}
+    # Cached outputs of pvdisplay and lvdisplay, shared by all instances.
+    # Invalidated when new volumes appear or volume groups are (de)activated.
+    _pv_cache: Optional[dict[Path, str]] = None
+    _lv_cache: Optional[dict[Path, str]] = None
+    _generation = 0
 
     @staticmethod
-    def list_logical_volumes():
-        return {Path(lv[0]): lv[1] for lv in LvmMountPlugin._run_colon_output(['lvdisplay', '--colon'])}
+    def _run_colon_output(args):
+        # Output is ASCII: split bytes and only decode the columns
+        return [[c.decode() for c in l.strip().split(b':')] for l in run_process(args).split(b'\n') if l.strip()]
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._generation += 1
+        cls._pv_cache = None
+        cls._lv_cache = None
+
+    @classmethod
+    def list_physical_volumes(cls) -> dict[Path, str]:
+        if (pvs := cls._pv_cache) is None:
+            generation = cls._generation
+            pvs = {Path(pv[0]): pv[1] for pv in cls._run_colon_output(['pvdisplay', '--colon'])}
+            # Do not cache results that were invalidated while pvdisplay was running
+            if generation == cls._generation:
+                cls._pv_cache = pvs
+        return pvs
+
+    @classmethod
+    def list_logical_volumes(cls) -> dict[Path, str]:
+        if (lvs := cls._lv_cache) is None:
+            generation = cls._generation
+            lvs = {Path(lv[0]): lv[1] for lv in cls._run_colon_output(['lvdisplay', '--colon'])}
+            if generation == cls._generation:
+                cls._lv_cache = lvs
+        return lvs
+
+    @classmethod
+    def activate_volume_group(cls, volume_group: str, readonly: bool):
+        try:
+            run_process(['vgchange', '--activate', 'y', '--yes', volume_group])
+        finally:
+            cls.invalidate_cache()
 
-    @staticmethod
-    def activate_volume_group(volume_group: str, readonly: bool):
-        run_process(['vgchange', '--activate', 'y', '--yes', volume_group])
+    @classmethod
+    def deactivate_volume_group(cls, volume_group: str):
+        try:
+            run_process(['vgchange', '--activate', 'n', volume_group])
+        finally:
+            cls.invalidate_cache()
 
-    @staticmethod
-    def deactivate_volume_group(volume_group: str):
-        run_process(['vgchange', '--activate', 'n', volume_group])
+    def mounted_volume(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> None:
+        # New block device that might be an LVM physical volume
+        self.invalidate_cache()
 
     def mount(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> Optional[Union[Path, VolumeInfo, list[VolumeInfo]]]:
         if volume_group := self.list_physical_volumes().get(volume_info.flat_mount):
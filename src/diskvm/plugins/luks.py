@@ -1,28 +1,158 @@
-import contextlib
+import base64
+import dataclasses
+import hashlib
+import hmac
+import json
 import logging
-import random
-import string
+import secrets
+import struct
 import tempfile
 from pathlib import Path
 from typing import Optional, Union
 
 from diskvm.data import VolumeInfo, DiskVmCreatorContext, DiskInfo
 from diskvm.errors import DiskVmError
+from diskvm.plugins import utils
 from diskvm.plugins.base import PluginSpec
 from diskvm.plugins.generic import LvmMountPlugin
-from diskvm.utils import run_process
+from diskvm.structure import Structure, bytes_field, Uint16, Uint32, Uint64, Endian
+from diskvm.utils import run_process, find_first, memory_file
 from diskvm.vm.base import VirtualDiskBuilder, VirtualDiskPart
 
+_LUKS_MAGIC = b'LUKS\xba\xbe'
+LUKS2_BINARY_HEADER_SIZE = 4096
+
+
+@dataclasses.dataclass()
+class Luks1Header(Structure):
+    endian = Endian.BIG
+
+    magic: bytes = bytes_field(size=6)
+    version: Uint16
+    cipher_name: bytes = bytes_field(size=32)
+    cipher_mode: bytes = bytes_field(size=32)
+    hash_spec: bytes = bytes_field(size=32)
+    payload_offset: Uint32
+    key_bytes: Uint32
+    mk_digest: bytes = bytes_field(size=20)
+    mk_digest_salt: bytes = bytes_field(size=32)
+    mk_digest_iter: Uint32
+    uuid: bytes = bytes_field(size=40)
+
+
+@dataclasses.dataclass()
+class Luks2BinaryHeader(Structure):
+    endian = Endian.BIG
+
+    magic: bytes = bytes_field(size=6)
+    version: Uint16
+    hdr_size: Uint64
+    seqid: Uint64
+    label: bytes = bytes_field(size=48)
+    checksum_alg: bytes = bytes_field(size=32)
+    salt: bytes = bytes_field(size=64)
+    uuid: bytes = bytes_field(size=40)
+
+
+@dataclasses.dataclass
+class LuksDigest:
+    """
+    PBKDF2 digest of the master key stored in the LUKS header
+    """
+    hash: str
+    salt: bytes
+    iterations: int
+    digest: bytes
+
+    def verify(self, key: bytes) -> bool:
+        return hmac.compare_digest(
+            hashlib.pbkdf2_hmac(self.hash, key, self.salt, self.iterations, len(self.digest)),
+            self.digest)
+
+
+@dataclasses.dataclass
+class LuksHeader:
+    version: int
+    digests: list[LuksDigest]
+    # Master key length. None if unknown
+    key_bytes: Optional[int] = None
+
+    def is_possible_master_key(self, key: bytes) -> bool:
+        """
+        Check a master key candidate in-process without calling cryptsetup.
+        Returns True if the key cannot be checked (e.g. unsupported hash algorithm).
+        """
+        if self.key_bytes is not None and len(key) != self.key_bytes:
+            # Do not run PBKDF2 for keys with the wrong length
+            return False
+        try:
+            return any(d.verify(key) for d in self.digests)
+        except ValueError:
+            return True
+
+
+def read_luks_header(flat_mount: Path) -> Optional[LuksHeader]:
+    data = utils.read_signature(flat_mount, offset=0, length=LUKS2_BINARY_HEADER_SIZE)
+    if len(data) < LUKS2_BINARY_HEADER_SIZE or not data.startswith(_LUKS_MAGIC):
+        return None
+
+    version = struct.unpack_from('>H', data, len(_LUKS_MAGIC))[0]
+    if version == 1:
+        header = Luks1Header.unpack(data[:Luks1Header.struct_size()])
+        return LuksHeader(version=1, digests=[LuksDigest(
+            hash=header.hash_spec.rstrip(b'\x00').decode(),
+            salt=header.mk_digest_salt,
+            iterations=header.mk_digest_iter,
+            digest=header.mk_digest,
+        )], key_bytes=header.key_bytes)
+    elif version == 2:
+        header = Luks2BinaryHeader.unpack(data[:Luks2BinaryHeader.struct_size()])
+        json_area = utils.read_signature(flat_mount, offset=LUKS2_BINARY_HEADER_SIZE,
+                                         length=header.hdr_size - LUKS2_BINARY_HEADER_SIZE)
+        metadata = json.loads(json_area.rstrip(b'\x00'))
+        digests = []
+        for d in metadata.get('digests', {}).values():
+            if d.get('type') != 'pbkdf2':
+                # Digest type cannot be checked in-process
+                return None
+            digests.append(LuksDigest(
+                hash=d['hash'],
+                salt=base64.b64decode(d['salt']),
+                iterations=d['iterations'],
+                digest=base64.b64decode(d['digest']),
+            ))
+        # All keyslots store the same master key
+        key_sizes = {k.get('key_size') for k in metadata.get('keyslots', {}).values()}
+        return LuksHeader(version=2, digests=digests, key_bytes=key_sizes.pop() if len(key_sizes) == 1 else None)
+    return None
+
+
+def get_luks_header(volume_info: VolumeInfo) -> Optional[LuksHeader]:
+    """
+    Parsed LUKS header of a volume. Read only once and cached in additional_info.
+    """
+    luks_info = volume_info.additional_info.setdefault('luks', {})
+    if 'header' not in luks_info:
+        try:
+            luks_info['header'] = read_luks_header(volume_info.flat_mount)
+        except (OSError, ValueError, KeyError, struct.error):
+            luks_info['header'] = None
+    return luks_info['header']
+
 
-@contextlib.contextmanager
 def master_key_file(key):
-    with tempfile.NamedTemporaryFile('wb') as f:
-        f.write(key)
-        f.flush()
-        yield f.name
+    return memory_file('luks-mk', key)
 
 
 def is_luks(volume_info: VolumeInfo):
+    # Check LUKS magic and header version in-process
+    header = utils.read_signature(volume_info.flat_mount, offset=0, length=len(_LUKS_MAGIC) + 2)
+    if len(header) < len(_LUKS_MAGIC) + 2 or header[:len(_LUKS_MAGIC)] != _LUKS_MAGIC:
+        return False
+    elif struct.unpack('>H', header[len(_LUKS_MAGIC):])[0] in (1, 2):
+        return True
+
+    # Unknown header version: let cryptsetup decide
     try:
         run_process(['cryptsetup', 'isLuks', volume_info.flat_mount])
         return True
@@ -30,12 +160,25 @@ def is_luks(volume_info: VolumeInfo):
         return False
 
 
-def try_mount_luks(volume_info: VolumeInfo, decrypt_args) -> Optional[VolumeInfo]:
+def deactivate_luks_lvm(luks_device: VolumeInfo):
+    """
+    Deactivate LVM volume groups that were automatically activated by crypsetup.
+    LVM will be handled by another plugin
+    """
+    try:
+        LvmMountPlugin.invalidate_cache()
+        if volume_group := LvmMountPlugin.list_physical_volumes().get(luks_device.flat_mount):
+            LvmMountPlugin.deactivate_volume_group(volume_group)
+    except DiskVmError:
+        logging.exception('Error while handling LUKS LVM volume groups')
+
+
+def try_mount_luks(volume_info: VolumeInfo, decrypt_args, pass_fds=(), handle_lvm=True) -> Optional[VolumeInfo]:
     try:
         # Mount LUKS
-        volume_name = 'luks-' + ''.join(random.choices(string.ascii_letters, k=10))
+        volume_name = 'luks-' + secrets.token_hex(5)
         run_process(['cryptsetup', 'open', '--type=luks', *(['--readonly'] if volume_info.disk_info.readonly else []),
-                     *decrypt_args, volume_info.flat_mount, volume_name])
+                     *decrypt_args, volume_info.flat_mount, volume_name], pass_fds=pass_fds)
         luks_device = VolumeInfo(
             disk_info=volume_info.disk_info,
             flat_mount=Path('/dev/mapper') / volume_name,
@@ -43,14 +186,8 @@ def try_mount_luks(volume_info: VolumeInfo, decrypt_args) -> Optional[VolumeInfo
             additional_info={'luks': {'mounted': True}}
         )
 
-        try:
-            # Deactivate LVM volume groups that were automatically activated by crypsetup
-            # LVM will be handled by another plugin
-            if volume_group := LvmMountPlugin.list_physical_volumes().get(luks_device.flat_mount):
-                LvmMountPlugin.deactivate_volume_group(volume_group)
-        except DiskVmError:
-            logging.exception('Error while handling LUKS LVM volume groups')
-
+        if handle_lvm:
+            deactivate_luks_lvm(luks_device)
         return luks_device
     except DiskVmError:
         return None
@@ -63,6 +200,7 @@ def unmount_luks(mount_point: VolumeInfo) -> bool:
     else:
         return False
 
+    utils.invalidate_head(mount_point.flat_mount)
     run_process(['cryptsetup', 'close', volume_name])
     return True
 
@@ -72,11 +210,25 @@ def find_master_key(volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> Optio
     if key := volume_info.additional_info.get('luks', {}).get('master_key'):
         return key
 
-    for key in ctx.options.additional_options.get('master_keys', []):
-        with master_key_file(key) as mk_filename:
-            if mount_point := try_mount_luks(volume_info, ['--master-key-file', mk_filename]):
-                unmount_luks(mount_point)
-                return key
+    header = get_luks_header(volume_info)
+
+    def try_key(key):
+        # Only try keys matching the master key digest. PBKDF2 runs in the worker threads (hashlib releases the GIL)
+        if header and not header.is_possible_master_key(key):
+            return None
+        with master_key_file(key) as mk_file:
+            # LVM caches are only invalidated once for the found key instead of in every trial
+            return try_mount_luks(volume_info, ['--master-key-file', mk_file.path], pass_fds=[mk_file.fd], handle_lvm=False)
+
+    def close_trial(luks_device: VolumeInfo):
+        deactivate_luks_lvm(luks_device)
+        unmount_luks(luks_device)
+
+    master_keys = ctx.options.additional_options.get('master_keys', [])
+    if found := find_first(try_key, master_keys, cleanup=close_trial):
+        key, mount_point = found
+        close_trial(mount_point)
+        return key
     return None
 
 
@@ -85,6 +237,7 @@ class LuksMountPlugin(PluginSpec):
         if is_luks(volume_info):
             logging.info(f'Detected LUKS volume: {volume_info}')
             volume_info.additional_info.setdefault('luks', {})['enabled'] = True
+            get_luks_header(volume_info)
 
     def mount(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> Optional[Union[Path, VolumeInfo, list[VolumeInfo]]]:
         if not volume_info.additional_info.get('luks', {}).get('enabled'):
@@ -93,9 +246,9 @@ class LuksMountPlugin(PluginSpec):
         logging.info(f'Try mounting LUKS volume {volume_info}')
 
         if mk := find_master_key(volume_info=volume_info, ctx=ctx):
-            with master_key_file(mk) as mk_filename:
+            with master_key_file(mk) as mk_file:
                 volume_info.additional_info['luks']['master_key'] = mk
-                return try_mount_luks(volume_info, ['--master-key-file', mk_filename])
+                return try_mount_luks(volume_info, ['--master-key-file', mk_file.path], pass_fds=[mk_file.fd])
 
         logging.warning(f'Could not mount LUKS volume {volume_info}')
         return None
@@ -113,17 +266,17 @@ class LuksAddPasswordPlugin(LuksMountPlugin):
 
         logging.info(f'Try adding password to LUKS volume {volume_info}')
         if mk := find_master_key(volume_info=volume_info, ctx=ctx):
-            with master_key_file(mk) as mk_filename:
+            with master_key_file(mk) as mk_file:
                 with tempfile.NamedTemporaryFile('w') as pw_file:
                     pw_file.write(self.NEW_PASSWORD)
                     pw_file.flush()
-                    run_process(['cryptsetup', 'luksAddKey', '--master-key-file', mk_filename,
-                                 volume_info.flat_mount, pw_file.name])
+                    run_process(['cryptsetup', 'luksAddKey', '--master-key-file', mk_file.path,
+                                 volume_info.flat_mount, pw_file.name], pass_fds=[mk_file.fd])
                     logging.info(f'Added LUKS password "{self.NEW_PASSWORD}" for {volume_info}')
-                    volume_info.additional_info['luks'] |= {
+                    volume_info.additional_info['luks'].update({
                         'password': self.NEW_PASSWORD,
                         'master_key': mk
-                    }
+                    })
         else:
             logging.warning(f'Could not find a matching LUKS master key {volume_info}')
 
@@ -1,4 +1,6 @@
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -19,6 +21,8 @@ class DetectOperatingSystemPlugin(PluginSpec):
         'Windows 8': 'windows8',
         'Windows 7': 'windows7',
     }
+    # Match all product name prefixes at once (in the order above)
+    WIN_PRODUCT_NAME_PATTERN = re.compile('|'.join(map(re.escape, WIN_GUESTOS_VMWARE)))
 
     def detect_windows(self, fs_root: Path) -> Optional[str]:
         # Read Windows version from Registry
@@ -30,9 +34,9 @@ class DetectOperatingSystemPlugin(PluginSpec):
                 win_product_name = reg.value('ProductName').value()
                 is_64bit = 'amd64' in reg.value('BuildLabEx').value().lower()
 
-                return [v for n, v in self.WIN_GUESTOS_VMWARE.items() if win_product_name.startswith(n)][0] +\
-                    ('-64' if is_64bit else '')
-            except (RegistryException, IndexError):
+                if m := self.WIN_PRODUCT_NAME_PATTERN.match(win_product_name):
+                    return self.WIN_GUESTOS_VMWARE[m.group(0)] + ('-64' if is_64bit else '')
+            except RegistryException:
                 pass
 
         return None
@@ -54,10 +58,15 @@ class DetectOperatingSystemPlugin(PluginSpec):
 
         logging.info('Begin OS detection')
 
-        for volume in disk_info.volumes:
-            if volume.filesystem_mount:
-                logging.debug(f'Detecting OS on {volume}')
-                if os := self.detect_os(volume.filesystem_mount):
+        def detect_volume_os(volume: VolumeInfo) -> Optional[str]:
+            logging.debug(f'Detecting OS on {volume}')
+            return self.detect_os(volume.filesystem_mount)
+
+        # Detect in parallel, but prefer the first volume with a detected OS
+        volumes = [v for v in disk_info.volumes if v.filesystem_mount]
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(volumes)))) as executor:
+            for os in executor.map(detect_volume_os, volumes):
+                if os:
                     # Successfully detected OS
                     logging.info(f'Detected Operating System: {os}')
                     ctx.additional_info[self.CONTEXT_KEY] = os
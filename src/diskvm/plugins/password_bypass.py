@@ -1,34 +1,54 @@
-import copy
 import crypt
+import functools
 import logging
+import mmap
+import re
 import struct
+from typing import Optional
 
 from Cryptodome.Cipher import DES, AES, ARC4
 from Cryptodome.Util.Padding import pad
 from Registry.Registry import Registry
-from impacket.examples.secretsdump import SAMHashes, LocalOperations, USER_ACCOUNT_V, SAM_HASH, SAM_HASH_AES
+from impacket.examples.secretsdump import CryptoCommon, SAMHashes, USER_ACCOUNT_V, SAM_HASH, SAM_HASH_AES
 from impacket.ntlm import compute_nthash
 
 from diskvm.data import VolumeInfo, DiskVmCreatorContext
 from diskvm.plugins.base import PluginSpec
 
 
+@functools.lru_cache(maxsize=1024)
+def _derive_des_keys(rid: int) -> tuple[bytes, bytes]:
+    # DES keys only depend on the RID
+    return CryptoCommon().deriveKey(rid)
+
+
 class WindowsRegistryOverridePasswordPlugin(PluginSpec):
     """
     Reset user account passwords by overwriting NTLM hashes in SAM registry hives.
     Based on impacket secretsdump.
     """
     NEW_PASSWORD = 'newpwd'
+    BOOTKEY_PERMUTATION = [8, 5, 4, 2, 11, 9, 13, 3, 0, 6, 1, 12, 14, 10, 15, 7]
+
+    @classmethod
+    def read_bootkey(cls, system: Registry) -> bytes:
+        """
+        Read the bootkey from the class names of the LSA keys in the SYSTEM hive.
+        Same as impacket LocalOperations.getBootKey(), but without parsing the hive again.
+        """
+        current_control_set = system.open('Select').value('Current').value()
+        lsa = system.open(f'ControlSet{current_control_set:03d}\\Control\\Lsa')
+        scrambled_key = bytes.fromhex(''.join(lsa.subkey(n)._nkrecord.classname()[:8] for n in ['JD', 'Skew1', 'GBG', 'Data']))  # noqa
+        return bytes(scrambled_key[i] for i in cls.BOOTKEY_PERMUTATION)
 
     @staticmethod
     def encrypt_nt_hash(helper: SAMHashes, rid, old_encrypted_hash, nt_hash):
-        crypto_common = helper._SAMHashes__cryptoCommon  # noqa
         hashed_bootkey = helper._SAMHashes__hashedBootKey  # noqa
 
-        key1, key2 = crypto_common.deriveKey(rid)
+        key1, key2 = _derive_des_keys(rid)
         key = DES.new(key1, DES.MODE_ECB).encrypt(nt_hash[:8]) + DES.new(key2, DES.MODE_ECB).encrypt(nt_hash[8:])
 
-        enc_hash = copy.deepcopy(old_encrypted_hash)
+        enc_hash = type(old_encrypted_hash)(old_encrypted_hash.getData())
         if isinstance(enc_hash, SAM_HASH_AES):
             enc_hash['Hash'] = AES.new(hashed_bootkey[:16], AES.MODE_CBC, enc_hash['Salt']).encrypt(pad(key, 16))
         elif isinstance(enc_hash, SAM_HASH):
@@ -38,33 +58,60 @@ class WindowsRegistryOverridePasswordPlugin(PluginSpec):
             raise Exception('Unknown NT Hash format')
         return enc_hash
 
-    def set_new_password(self, helper: SAMHashes, rid: int, user_account: USER_ACCOUNT_V):
+    def set_new_password(self, helper: SAMHashes, rid: int, user_account: USER_ACCOUNT_V, new_nt_hash: bytes = None) -> Optional[bytes]:
+        """
+        Replace the NT hash in user_account (modified in-place).
+        Returns the new data of the "V" registry value or None if the user has no NT hash.
+        """
         if user_account['NTHashLength'] == 0:
             # User has no NT hash
             return None
 
         data = user_account['Data']
+        # Slice only the NT hash instead of copying the remaining data
+        nt_hash_offset, nt_hash_length = user_account['NTHashOffset'], user_account['NTHashLength']
+        enc_nt_hash_data = data[nt_hash_offset:nt_hash_offset + nt_hash_length]
         enc_nt_hash = None
-        if data[user_account['NTHashOffset']:][2:3] == b'\x01':
-            if user_account['NTHashLength'] == 20:
-                enc_nt_hash = SAM_HASH(data[user_account['NTHashOffset']:][:user_account['NTHashLength']])
-                # nt_hash = helper._SAMHashes__decryptHash(rid, enc_nt_hash, b"NTPASSWORD\0", False)
+        if enc_nt_hash_data[2:3] == b'\x01':
+            if nt_hash_length == 20:
+                enc_nt_hash = SAM_HASH(enc_nt_hash_data)
         else:
-            if user_account['NTHashLength'] == 56:
-                enc_nt_hash = SAM_HASH_AES(data[user_account['NTHashOffset']:][:user_account['NTHashLength']])
-                # nt_hash = helper._SAMHashes__decryptHash(rid, enc_nt_hash, b"NTPASSWORD\0", True)
+            if nt_hash_length == 56:
+                enc_nt_hash = SAM_HASH_AES(enc_nt_hash_data)
 
         if not enc_nt_hash:
             return None
 
+        old_nt_hash = helper._SAMHashes__decryptHash(rid, enc_nt_hash, b"NTPASSWORD\0", isinstance(enc_nt_hash, SAM_HASH_AES))  # noqa
+        logging.info(f'Found NTLM hash for user with RID {rid}: {old_nt_hash.hex()}')
+
         # Calculate NT hash of new password
-        new_nt_hash = compute_nthash(self.NEW_PASSWORD)
+        new_nt_hash = new_nt_hash or compute_nthash(self.NEW_PASSWORD)
         new_enc_hash = self.encrypt_nt_hash(helper, rid, enc_nt_hash, new_nt_hash)
 
         # Replace NT hash in registry
-        user_account = copy.deepcopy(user_account)
-        user_account['Data'] = data[:user_account['NTHashOffset']] + new_enc_hash.getData() + data[user_account['NTHashOffset'] + user_account['NTHashLength']:]
-        return user_account
+        user_account['Data'] = data[:nt_hash_offset] + new_enc_hash.getData() + data[nt_hash_offset + nt_hash_length:]
+        return user_account.getData()
+
+    @staticmethod
+    def write_changes(path, changes: list[tuple[int, bytes]]):
+        """
+        Write changed regions (offset, data) of a file in-place. Only the changed pages are written instead of the whole file.
+        Falls back to seek() and write() if the file cannot be mapped (e.g. FUSE mounts with direct_io).
+        """
+        with open(path, 'r+b') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0) as data:
+                    for offset, new_data in changes:
+                        data[offset:offset + len(new_data)] = new_data
+                    data.flush()
+                return
+            except (OSError, ValueError):
+                logging.debug(f'Could not write changes to {path} with mmap')
+
+            for offset, new_data in changes:
+                f.seek(offset)
+                f.write(new_data)
 
     def modify_filesystem(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext):
         sys32_config = volume_info.filesystem_mount / 'Windows' / 'System32' / 'config'
@@ -77,36 +124,42 @@ class WindowsRegistryOverridePasswordPlugin(PluginSpec):
             helper = None
             try:
                 # Read bootkey from registry
-                bootkey = LocalOperations(systemHive=system_file).getBootKey()
-                helper = SAMHashes(samFile=sam_file, bootKey=bootkey, perSecretCallback=lambda h: logging.info(f'Found NTLM hash for user: {h}'))
-                helper.dump()
-
-                sam = Registry(sam_file)
-                sam_data = bytearray(sam._buf)
+                bootkey = self.read_bootkey(Registry(str(system_file)))
+                helper = SAMHashes(samFile=sam_file, bootKey=bootkey)
+                # Only decrypt the hashed bootkey. NT hashes are decrypted while iterating users below
+                helper.getHBootKey()
+
+                sam = Registry(str(sam_file))
+                # Changed regions of the SAM file: (offset, data)
+                sam_changes = []
+                # Same for all users
+                new_nt_hash = compute_nthash(self.NEW_PASSWORD)
                 for k in sam.open('SAM\\Domains\\Account\\Users').subkeys():
                     if k.name() == 'Names':
                         continue
 
-                    user_account = USER_ACCOUNT_V(k.value('V').value())
+                    v = k.value('V')
+                    user_account = USER_ACCOUNT_V(v.value())
                     user_name = user_account['Data'][user_account['NameOffset']:user_account['NameOffset'] + user_account['NameLength']].decode('UTF-16')
-                    new_user_account = self.set_new_password(helper=helper, rid=int(k.name(), 16), user_account=user_account)
-                    if not new_user_account:
+                    new_user_data = self.set_new_password(helper=helper, rid=int(k.name(), 16), user_account=user_account,
+                                                          new_nt_hash=new_nt_hash)
+                    if not new_user_data:
                         continue
-                    new_user_data = new_user_account.getData()
 
                     # Write data back to registry file
                     # quick and dirty workaround, because the library does not support writing back to registry
-                    data_offset = k.value('V')._vkrecord.data_offset() + 4
-                    sam_data[data_offset:data_offset + len(new_user_data)] = new_user_data
+                    sam_changes.append((v._vkrecord.data_offset() + 4, new_user_data))
 
                     logging.info(f'Changed Windows password for user {user_name} to "{self.NEW_PASSWORD}"')
 
                 try:
-                    sam_file.write_bytes(sam_data)
-                except OSError:
+                    self.write_changes(sam_file, sam_changes)
+                    if sam_changes:
+                        volume_info.additional_info['windows_password'] = {'password': self.NEW_PASSWORD}
+                except OSError as ex:
                     # Occurs if NTFS partition could not be mounted correctly
-                    logging.warning(f'Password bypass failed: Could not write to SAM file {sam_file}')
-                    pass
+                    logging.error(f'Password bypass failed: Could not write to SAM file {sam_file}: {ex}')
+                    volume_info.additional_info['windows_password'] = {'error': str(ex)}
             finally:
                 if helper:
                     helper.finish()
@@ -114,24 +167,27 @@ class WindowsRegistryOverridePasswordPlugin(PluginSpec):
 
 class EtcShadowBlankPasswords(PluginSpec):
     NEW_PASSWORD = 'newpwd'
+    # user:password: where the password field is not only "!" or "*" (locked account/no password login)
+    PASSWORD_FIELD_PATTERN = re.compile(rb'^([^:\n]*):(?![!*](?::|$))[^:\n]*', flags=re.MULTILINE)
 
     def __init__(self, hash_method=crypt.METHOD_SHA256):
         self.hash_method = hash_method
 
     def hash_password(self, password: str) -> str:
-        # Use a SHA512 hash by default
-        return crypt.crypt(password, self.hash_method)
+        # Use a SHA256 hash by default
+        return crypt.crypt(password, crypt.mksalt(self.hash_method))
 
     def modify_filesystem(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext):
         etc_shadow = volume_info.filesystem_mount / 'etc/shadow'
         if etc_shadow.exists():
             logging.info(f'Overriding passwords in /etc/shadow of {volume_info}')
 
-            # Override all set passwords with a plaintext password
-            entries = [l.split(':') for l in etc_shadow.read_text().splitlines()]
-            for e in entries:
-                if len(e) >= 2 and e[1] not in ['!', '*']:
-                    e[1] = self.hash_password(self.NEW_PASSWORD)
-                    logging.info(f'Password for user "{e[0]}" now is "{self.NEW_PASSWORD}"')
-            etc_shadow.write_text('\n'.join(map(lambda l: ':'.join(l), entries)))
+            # All users get the same password: only run the key stretching once
+            password_hash = self.hash_password(self.NEW_PASSWORD).encode()
 
+            def replace_password(m: re.Match) -> bytes:
+                logging.info(f'Password for user "{m.group(1).decode()}" now is "{self.NEW_PASSWORD}"')
+                return m.group(1) + b':' + password_hash
+
+            # Override all set passwords with a plaintext password
+            etc_shadow.write_bytes(self.PASSWORD_FIELD_PATTERN.sub(replace_password, etc_shadow.read_bytes()))
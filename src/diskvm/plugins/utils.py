@@ -1,15 +1,76 @@
+import collections
+import os
+import threading
 from pathlib import Path
 
 BOOTCODE_LEN = 3
 NTFS_SIGNATURE = b'NTFS    '
 
 
+# Size of the cached first bytes of files and devices. Contains the boot sector and most other volume signatures.
+HEAD_SIZE = 4096
+
+# Maximum number of cached heads (LRU)
+HEAD_CACHE_SIZE = 256
+
+_head_cache: collections.OrderedDict[str, tuple[tuple[int, int], bytes]] = collections.OrderedDict()
+_head_cache_lock = threading.Lock()
+
+
+def _read_head(path: Path) -> bytes:
+    """
+    Read the first HEAD_SIZE bytes of a file or block device.
+    Cached by path, inode and mtime until invalidated with invalidate_head(). Thread-safe.
+    """
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns)
+    with _head_cache_lock:
+        if (cached := _head_cache.get(str(path))) and cached[0] == key:
+            _head_cache.move_to_end(str(path))
+            return cached[1]
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        head = os.pread(fd, HEAD_SIZE, 0)
+    finally:
+        os.close(fd)
+    with _head_cache_lock:
+        _head_cache[str(path)] = (key, head)
+        _head_cache.move_to_end(str(path))
+        if len(_head_cache) > HEAD_CACHE_SIZE:
+            _head_cache.popitem(last=False)
+    return head
+
+
+def read_signature(path: Path, offset: int, length: int) -> bytes:
+    """
+    Read a few bytes (e.g. a magic number) from a file or block device.
+    """
+    if offset + length <= HEAD_SIZE:
+        return _read_head(path)[offset:offset + length]
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+
+
+def invalidate_head(path: Path):
+    """
+    Must be called when a file or device was modified or detached, because device paths (e.g. loop devices) are re-used.
+    """
+    with _head_cache_lock:
+        _head_cache.pop(str(path), None)
+
+
+def _signature_probe(path: Path, signature: bytes, offset: int) -> bool:
+    return read_signature(path, offset, len(signature)) == signature
+
+
 def is_signature(flat_mount: Path, signature: bytes, bootcode_len: int = BOOTCODE_LEN):
-    with open(flat_mount, 'rb') as f:
-        magic = f.read(bootcode_len + len(signature))[bootcode_len:]
-    return magic == signature
+    return _signature_probe(flat_mount, signature, bootcode_len)
 
 
 def is_ntfs(flat_mount: Path):
     return is_signature(flat_mount, NTFS_SIGNATURE)
-
@@ -1,16 +1,17 @@
 import dataclasses
 import enum
-import hashlib
+import functools
 import logging
-import random
+import os
+import secrets
 import shutil
-import string
-import tempfile
-from binascii import crc32
+import struct
 from enum import Enum
 from pathlib import Path
 from typing import Union, Optional
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import algorithms, modes, Cipher
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 from diskvm.data import DiskInfo, DiskVmCreatorContext, VolumeInfo
 from diskvm.errors import DiskVmError
@@ -18,20 +19,57 @@ from diskvm.plugins import utils
 from diskvm.plugins.base import PluginSpec
 from diskvm.plugins.os_detect import DetectEfiPlugin
 from diskvm.structure import Structure, bytes_field, Uint16, Uint32, Uint64, Endian
-from diskvm.utils import run_process
+from diskvm.utils import run_process, memory_file
 from diskvm.vm.base import VirtualDiskBuilder, VirtualDiskPart
 
+try:
+    # Optional: SIMD-accelerated CRC-32 (IEEE 802.3 polynomial, same as binascii.crc32)
+    from fastcrc.crc32 import iso_hdlc as crc32
+except ImportError:
+    from binascii import crc32
+
 
 class VeraCryptCipher(Enum):
     AES256_XTS = 'aes-xts-plain64'
 
 
+# Algorithm and key length in bytes
+_CIPHER_ALGORITHMS = {
+    VeraCryptCipher.AES256_XTS: (algorithms.AES, 64),
+}
+
+
 class VeraCryptFlags(enum.Flag):
     SYSTEM_ENCRYPTION = 1
     # non-system in-place-encrypted/decrypted volume
     NON_SYSTEM_IN_PLACE_ENCRYPTED = 2
 
 
+def xts_encrypt(algorithm, data: bytes, tweak: bytes = b'\x00' * 16, prefix: bytes = b'') -> bytes:
+    """
+    Encrypt a data unit (e.g. a sector) with a single call into OpenSSL.
+    The ciphertext is written directly after prefix into one preallocated buffer.
+    XTS processes the whole input in update_into(). finalize() does not return any data and can be skipped.
+    """
+    # update_into() requires space for an additional block
+    out = bytearray(len(prefix) + len(data) + algorithm.block_size // 8 - 1)
+    out[:len(prefix)] = prefix
+    with memoryview(out) as view:
+        length = Cipher(algorithm, modes.XTS(tweak)).encryptor().update_into(data, view[len(prefix):])
+    del out[len(prefix) + length:]
+    return bytes(out)
+
+
+def xts_decrypt(algorithm, data: bytes, tweak: bytes = b'\x00' * 16) -> bytes:
+    return Cipher(algorithm, modes.XTS(tweak)).decryptor().update(data)
+
+
+@functools.lru_cache(maxsize=32)
+def _derive_header_key(password: bytes, salt: bytes, key_length: int) -> bytes:
+    # 500000 iterations are expensive: cache keys for repeated encryption with the same password and salt
+    return PBKDF2HMAC(algorithm=hashes.SHA512(), length=key_length, salt=salt, iterations=500000).derive(password)
+
+
 @dataclasses.dataclass()
 class VeraCryptHeader(Structure):
     endian = Endian.BIG
@@ -54,30 +92,40 @@ class VeraCryptHeader(Structure):
     checksum_header_fields: Uint32 = 0
     master_keys: bytes = bytes_field(size=256, default=b'\x00' * 256)
 
-    def update_checksums(self):
+    # Byte offsets in the packed header
+    _CHECKSUM_MASTER_KEYS_POS = 8
+    _CHECKSUM_HEADER_FIELDS_POS = 188
+
+    def pack_with_checksums(self) -> bytearray:
+        """
+        Calculate checksums and pack the header. The header is only serialized once.
+        """
+        header_data = bytearray(self.pack())
         # Calculate checksums
         self.checksum_master_keys = Uint32(crc32(self.master_keys))
-        header_data = self.pack()
+        struct.pack_into('>I', header_data, self._CHECKSUM_MASTER_KEYS_POS, self.checksum_master_keys)
         # Checksum of header fields (includes checksum of master keys)
-        self.checksum_header_fields = Uint32(crc32(header_data[:188]))
+        with memoryview(header_data) as view:
+            self.checksum_header_fields = Uint32(crc32(view[:self._CHECKSUM_HEADER_FIELDS_POS]))
+        struct.pack_into('>I', header_data, self._CHECKSUM_HEADER_FIELDS_POS, self.checksum_header_fields)
+        return header_data
 
-    def encrypt(self, password: str, cipher: VeraCryptCipher = VeraCryptCipher.AES256_XTS, salt: bytes = None):
-        cipher_instance, key_length = {
-            VeraCryptCipher.AES256_XTS: (algorithms.AES, 64),
-        }[cipher]
+    def update_checksums(self):
+        self.pack_with_checksums()
+
+    def encrypt(self, password: str, cipher: VeraCryptCipher = VeraCryptCipher.AES256_XTS, salt: bytes = None,
+                update_checksums: bool = False):
+        key_length = _CIPHER_ALGORITHMS[cipher][1]
 
         # Derive header key from password
         # Generate a new password (does not matter which)
         # Use SHA512 (arbitrary algorithm) and no PIM
-        salt = salt or random.randbytes(64)
-        header_key = hashlib.pbkdf2_hmac('SHA512', password=password.encode('ASCII'), salt=salt, iterations=500000,
-                                         dklen=key_length)
+        salt = salt or os.urandom(64)
+        header_key = _derive_header_key(password=password.encode('ASCII'), salt=salt, key_length=key_length)
 
         # Encrypt header
-        header_data = self.pack()
-        enc = Cipher(cipher_instance(key=header_key), modes.XTS(b'\x00' * 16)).encryptor()
-        encrypted = enc.update(header_data) + enc.finalize()
-        return salt + encrypted
+        header_data = self.pack_with_checksums() if update_checksums else self.pack()
+        return xts_encrypt(_CIPHER_ALGORITHMS[cipher][0](key=header_key), header_data, prefix=salt)
 
 
 @dataclasses.dataclass
@@ -93,6 +141,7 @@ def unmount_veracrypt(mount_point: Union[Path, VolumeInfo]) -> bool:
     if not isinstance(mount_point, Path) or not mount_point.exists():
         return False
 
+    utils.invalidate_head(mount_point)
     try:
         run_process(['cryptsetup', 'close', mount_point.name])
         return True
@@ -100,18 +149,37 @@ def unmount_veracrypt(mount_point: Union[Path, VolumeInfo]) -> bool:
         return False
 
 
+def is_possible_master_key(volume_info: VolumeInfo, master_key: VeraCryptMasterKey) -> bool:
+    """
+    Check a master key candidate in-process without calling cryptsetup:
+    decrypt the first sector of the volume and check for the NTFS signature (see try_mount_veracrypt).
+    Returns True if the key cannot be checked.
+    """
+    if master_key.cipher != VeraCryptCipher.AES256_XTS:
+        return True
+
+    sector_size = volume_info.disk_info.sector_size
+    # aes-xts-plain64: the tweak is the (absolute) sector number
+    tweak = (volume_info.offset // sector_size).to_bytes(16, 'little')
+    try:
+        boot_sector = xts_decrypt(algorithms.AES(master_key.key),
+                                  utils.read_signature(volume_info.flat_mount, offset=0, length=sector_size), tweak)
+    except (OSError, ValueError):
+        # Invalid key length or sector could not be read
+        return True
+    return boot_sector[utils.BOOTCODE_LEN:utils.BOOTCODE_LEN + len(utils.NTFS_SIGNATURE)] == utils.NTFS_SIGNATURE
+
+
 def try_mount_veracrypt(volume_info: VolumeInfo, master_key: VeraCryptMasterKey) -> Optional[VolumeInfo]:
     mount_device = None
     try:
-        volume_name = 'veracrypt-' + ''.join(random.choices(string.ascii_letters, k=10))
-        with tempfile.NamedTemporaryFile('wb') as mk_file:
-            mk_file.write(master_key.key)
-            mk_file.flush()
+        volume_name = 'veracrypt-' + secrets.token_hex(5)
+        with memory_file('veracrypt-mk', master_key.key) as mk_file:
             run_process(['cryptsetup', 'open', '--type=plain', *(['--readonly'] if volume_info.disk_info.readonly else []),
                          '--cipher', master_key.cipher.value,
-                         '--key-file', mk_file.name, '--key-size', str(len(master_key.key) * 8),
+                         '--key-file', mk_file.path, '--key-size', str(len(master_key.key) * 8),
                          '--skip', str(volume_info.offset // volume_info.disk_info.sector_size),
-                         volume_info.flat_mount, volume_name])
+                         volume_info.flat_mount, volume_name], pass_fds=[mk_file.fd])
             mount_device = Path('/dev/mapper') / volume_name
 
         # Check if filesystem signature is NTFS
@@ -136,12 +204,16 @@ def find_master_key(volume_info: VolumeInfo, ctx: DiskVmCreatorContext) -> Optio
     if key := volume_info.additional_info.get('veracrypt', {}).get('master_key'):
         return key
 
-    for key in ctx.options.additional_options.get('master_keys', []):
-        for cipher in list(VeraCryptCipher):
-            master_key = VeraCryptMasterKey(key=key, cipher=cipher)
-            if mount_point := try_mount_veracrypt(volume_info=volume_info, master_key=master_key):
-                unmount_veracrypt(mount_point)
-                return master_key
+    candidates = [VeraCryptMasterKey(key=key, cipher=cipher)
+                  for key in ctx.options.additional_options.get('master_keys', [])
+                  for cipher in list(VeraCryptCipher)]
+    candidates = [mk for mk in candidates if is_possible_master_key(volume_info=volume_info, master_key=mk)]
+
+    # Try remaining candidates serially: cryptsetup refuses to map a device that is already mapped by another trial
+    for master_key in candidates:
+        if mount_point := try_mount_veracrypt(volume_info=volume_info, master_key=master_key):
+            unmount_veracrypt(mount_point)
+            return master_key
     return None
 
 
@@ -174,8 +246,14 @@ class VeraCryptMountPlugin(PluginSpec):
 class VeraCryptOverridePasswordPlugin(VeraCryptMountPlugin):
     NEW_PASSWORD = 'newpwd'
 
+    def __init__(self):
+        super().__init__()
+        # Header salt shared by all volumes modified by this plugin. The header key is only derived once.
+        self.header_salt = os.urandom(64)
+
     @classmethod
-    def create_encrypted_veracrypt_header(cls, system_partition: VolumeInfo, master_key: VeraCryptMasterKey, password: str) -> bytes:
+    def create_encrypted_veracrypt_header(cls, system_partition: VolumeInfo, master_key: VeraCryptMasterKey, password: str,
+                                          salt: bytes = None) -> bytes:
         # Create header
         header = VeraCryptHeader(
             sector_size=Uint32(512),
@@ -185,8 +263,7 @@ class VeraCryptOverridePasswordPlugin(VeraCryptMountPlugin):
             flags=Uint32(VeraCryptFlags.SYSTEM_ENCRYPTION.value),
             master_keys=master_key.key.ljust(256, b'\x00')
         )
-        header.update_checksums()
-        return header.encrypt(password=password, cipher=master_key.cipher)
+        return header.encrypt(password=password, cipher=master_key.cipher, salt=salt, update_checksums=True)
 
     def modify_volume(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext):
         if not volume_info.disk_info.additional_info.get('veracrypt', {}).get('system_encryption_enabled') or \
@@ -201,7 +278,8 @@ class VeraCryptOverridePasswordPlugin(VeraCryptMountPlugin):
             f.write(self.create_encrypted_veracrypt_header(
                 system_partition=volume_info.parent,
                 master_key=volume_info.parent.additional_info['veracrypt']['master_key'],
-                password=self.NEW_PASSWORD
+                password=self.NEW_PASSWORD,
+                salt=self.header_salt,
             ))
         logging.info(f'Changed VeraCrypt password to "{self.NEW_PASSWORD}" {volume_info.disk_info}')
 
@@ -1,20 +1,24 @@
 import contextlib
 import logging
 import os
-import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Optional
 
 from diskvm.data import DiskVmCreatorOptions, DiskVmCreatorContext, DiskInfo, VolumeInfo, PartitionScheme
 from diskvm.errors import InvalidDiskError, DiskVmError
+from diskvm.plugins import utils as plugin_utils
 from diskvm.plugins.base import PluginManager
 from diskvm.plugins.generic import GenericMountPlugin, LvmMountPlugin
-from diskvm.utils import run_process, groupby, size_blockdevice
-from diskvm.vm.base import VirtualizationSoftware, VirtualDisk, VirtualMachine, VirtualDiskPart
+from diskvm.utils import run_process, groupby, size_blockdevice, stat_path
+from diskvm.vm.base import VirtualizationSoftware, VirtualDisk, VirtualMachine, VirtualDiskPart, VirtualDiskBuilder
 
 
 class DiskVmCreator:
+    # Seconds to wait for udev to create the partition device nodes of a loop device
+    PARTITION_DEVICE_TIMEOUT = 5
+
     def __init__(self, virtualization_software: VirtualizationSoftware):
         self.virtualization_software = virtualization_software
 
@@ -23,32 +27,37 @@ class DiskVmCreator:
         self._init_default_plugins()
 
     def _init_default_plugins(self):
-        self.plugins.fallback_plugins.append(GenericMountPlugin())
-        self.plugins.fallback_plugins.append(LvmMountPlugin())
+        self.plugins.add_fallback(GenericMountPlugin(), LvmMountPlugin())
 
     def _create_context(self, options: DiskVmCreatorOptions):
         return DiskVmCreatorContext(instance=self, options=options)
 
     def _validate_options(self, options: DiskVmCreatorOptions):
         # Ensure virtualization software is installed on host system
-        self.virtualization_software.check_available()
+        self.virtualization_software.ensure_available()
 
         # Check that disk images exist and are either files or attached disks (block devices)
         for disk_image in options.all_disk_images:
-            if not disk_image.exists() or (not disk_image.is_file() and not disk_image.is_block_device()):
+            disk_image_stat = stat_path(disk_image)
+            if not disk_image_stat.is_file and not disk_image_stat.is_block_device:
                 raise InvalidDiskError(disk_image)
 
         # Create output directory
         options.out_dir.mkdir(exist_ok=True)
 
-    def _add_virtual_disk(self, disk_image: Path, ctx: DiskVmCreatorContext):
+    def _add_virtual_disk(self, disk_image: Path, disk_builder: VirtualDiskBuilder,
+                          ctx: DiskVmCreatorContext) -> Optional[contextlib.ExitStack]:
+        """
+        Analyze a disk image and fill the virtual disk builder.
+        Can run in parallel for multiple disks. Returns the mount contexts of disks that have to be kept
+        mounted while the VM runs.
+        """
         with contextlib.ExitStack() as mounts:
             logging.info(f'Begin building virtual disk for {disk_image}')
 
             logging.info(f'Mounting disk read-only {disk_image}')
             disk_info = mounts.enter_context(self.mount_disk_image(disk_image, ctx))
 
-            disk_builder = ctx.vm_builder.new_disk()
             disk_builder.sector_size = disk_info.sector_size
             disk_builder.add_part(VirtualDiskPart(source_file=disk_image, length=size_blockdevice(disk_image)))
 
@@ -61,12 +70,39 @@ class DiskVmCreator:
             self.plugins.dispatch_all('before_create_disk', disk_builder=disk_builder, disk_info=disk_info, ctx=ctx)
 
             logging.info(f'Finished building virtual disk for {disk_info}')
-            ctx.vm_builder.add_disk(disk_builder)
 
             if disk_info.keep_mounted:
                 # Keep disks and volumes mounted while VM is running
-                # Transfer to mount context manager to outer context manager
-                ctx.mount_contexts.enter_context(mounts.pop_all())
+                # Transfer the mount contexts to the caller
+                return mounts.pop_all()
+        return None
+
+    def _add_virtual_disks(self, ctx: DiskVmCreatorContext):
+        disk_images = ctx.options.all_disk_images
+
+        # Create and add disk builders in order of disk images (disk builder names are numbered)
+        disk_builders = []
+        for _ in disk_images:
+            disk_builder = ctx.vm_builder.new_disk()
+            ctx.vm_builder.add_disk(disk_builder)
+            disk_builders.append(disk_builder)
+
+        # Mounting disks mostly waits for subprocesses: build disks in parallel
+        with ThreadPoolExecutor(max_workers=min(len(disk_images), 2 * (os.cpu_count() or 1))) as executor:
+            futures = [executor.submit(self._add_virtual_disk, disk_image=disk_image, disk_builder=disk_builder, ctx=ctx)
+                       for disk_image, disk_builder in zip(disk_images, disk_builders)]
+
+        # Transfer mount contexts to the outer context manager in the main thread,
+        # also if building other disks failed
+        error = None
+        for future in futures:
+            try:
+                if mounts := future.result():
+                    ctx.mount_contexts.enter_context(mounts)
+            except Exception as ex:
+                error = error or ex
+        if error:
+            raise error
 
     def _create_vm(self, ctx: DiskVmCreatorContext) -> VirtualMachine:
         logging.info('Initializing VM builder')
@@ -77,8 +113,7 @@ class DiskVmCreator:
         ctx.vm_builder.firmware = ctx.options.firmware
 
         # Add disk images
-        for disk_image in ctx.options.all_disk_images:
-            self._add_virtual_disk(disk_image=disk_image, ctx=ctx)
+        self._add_virtual_disks(ctx=ctx)
 
         # Write VM to filesystem
         self.plugins.dispatch_all('before_create_vm', ctx=ctx)
@@ -90,41 +125,57 @@ class DiskVmCreator:
 
     @contextlib.contextmanager
     def mount_disk(self, disk: VirtualDisk, readonly: bool, ctx: DiskVmCreatorContext):
-        disk_info = None
+        with self.mount_disks(disks=[disk], readonly=readonly, ctx=ctx) as disk_infos:
+            yield disk_infos[0]
+
+    @contextlib.contextmanager
+    def mount_disks(self, disks: list[VirtualDisk], readonly: bool, ctx: DiskVmCreatorContext):
+        """
+        Mount virtual disks in parallel and dispatch the disk plugins for each disk in order.
+        """
+        flat_disks = []
         try:
-            disk_info = DiskInfo(flat_mounted_disk=disk.mount(readonly=readonly), readonly=readonly)
+            flat_disks = self.virtualization_software.mount_disks(disks, readonly=readonly)
 
-            self.plugins.dispatch_all('mounted_disk', disk_info=disk_info, ctx=ctx)
-            if not disk_info.readonly:
-                self.plugins.dispatch_all('modify_disk', disk_info=disk_info, ctx=ctx)
-                disk_info.refresh_disk_info()
+            disk_infos = []
+            for flat_disk in flat_disks:
+                disk_info = DiskInfo(flat_mounted_disk=flat_disk, readonly=readonly)
+                disk_infos.append(disk_info)
 
-            yield disk_info
+                self.plugins.dispatch_all('mounted_disk', disk_info=disk_info, ctx=ctx)
+                if not disk_info.readonly:
+                    self.plugins.dispatch_all('modify_disk', disk_info=disk_info, ctx=ctx)
+                    disk_info.refresh_disk_info()
+                    plugin_utils.invalidate_head(disk_info.flat_mounted_disk)
+
+            yield disk_infos
         finally:
-            if disk_info and disk_info.flat_mounted_disk.exists():
-                disk.unmount()
-                disk_info.flat_mounted_disk.parent.rmdir()
+            mounted = [(disk, flat_disk) for disk, flat_disk in zip(disks, flat_disks) if flat_disk.exists()]
+            self.virtualization_software.unmount_disks([disk for disk, _ in mounted],
+                                                        flat_disks=[flat_disk for _, flat_disk in mounted])
 
     @contextlib.contextmanager
     def mount_disk_image(self, disk_image: Path, ctx: DiskVmCreatorContext):
-        mount_point = None
+        mount_point = ctx.mount_point_pool.get()
+        mounted = False
         try:
-            fd, mount_point = tempfile.mkstemp()
-            mount_point = Path(mount_point)
-            os.close(fd)
             run_process(['mount', '--read-only', '--bind', str(disk_image), str(mount_point)])
+            mounted = True
 
             disk_info = DiskInfo(flat_mounted_disk=mount_point, readonly=True)
             self.plugins.dispatch_all('mounted_disk', disk_info=disk_info, ctx=ctx)
 
             yield disk_info
         finally:
-            if mount_point and mount_point.exists():
-                try:
+            try:
+                if mounted:
                     run_process(['umount', str(mount_point)])
-                except DiskVmError:
-                    pass
-                mount_point.unlink()
+                    # Mount point paths are re-used for other disk images
+                    plugin_utils.invalidate_head(mount_point)
+                ctx.mount_point_pool.put(mount_point)
+            except DiskVmError:
+                # Still mounted: do not re-use the mount point
+                logging.exception(f'Error while unmounting disk image {disk_image}')
 
     @contextlib.contextmanager
     def mount_partitions_and_filesystems(self, disk_info: DiskInfo, ctx: DiskVmCreatorContext):
@@ -136,12 +187,9 @@ class DiskVmCreator:
             self.unmount_partitions_and_filesystems(disk_info=disk_info, ctx=ctx)
 
     def unmount_partitions_and_filesystems(self, disk_info: DiskInfo, ctx: DiskVmCreatorContext):
-        def volume_depth(v: VolumeInfo):
-            return 0 if not v.parent else 1 + volume_depth(v.parent)
-
         # Unmount filesystems and volumes
         # First unmount nested (child) volumes, then parent volumes
-        for depth, volumes in groupby(disk_info.volumes, key=volume_depth, reverse=True):
+        for depth, volumes in groupby(disk_info.volumes, key=lambda v: v.depth, reverse=True):
             for v in volumes:
                 if v.filesystem_mount and v.filesystem_mount.exists():
                     try:
@@ -156,82 +204,201 @@ class DiskVmCreator:
                 if v.flat_mount and v.flat_mount.exists():
                     try:
                         if self.plugins.dispatch_until_result('unmount_volume', volume_info=v, ctx=ctx):
+                            plugin_utils.invalidate_head(v.flat_mount)
                             v.flat_mount = None
                         else:
                             logging.warning(f'Could not unmount volume {v}')
                     except DiskVmError:
                         logging.exception(f'Error while unmounting volume {v}')
 
-    def _add_partition_info(self, disk_info: DiskInfo, offset: int, size: int,
-                            volume_type: Any, volume_info: Optional[Any], ctx: DiskVmCreatorContext):
-        loop_dev = Path(run_process([
-            'losetup', '--find', '--show', *(['--read-only'] if disk_info.readonly else []),
-            '--offset', str(offset), '--sizelimit', str(size),
-            str(disk_info.flat_mounted_disk)
-        ]).decode().strip('\n'))
-
+        # Partition devices are removed together with the partition-scanned loop device of the disk
+        if disk_loop_dev := disk_info.additional_info.pop('loop', {}).get('device'):
+            try:
+                run_process(['losetup', '--detach', str(disk_loop_dev)])
+                plugin_utils.invalidate_head(disk_loop_dev)
+            except DiskVmError:
+                logging.exception(f'Error while detaching loop device {disk_loop_dev}')
+
+    @staticmethod
+    def _losetup(disk_info: DiskInfo, args: list[str], direct_io: bool) -> Path:
+        """
+        Set up a loop device for the disk and return its path. Thread-safe.
+        With direct_io, reads bypass the page cache of the loop device (the backing file is cached anyway).
+        """
+        losetup_args = ['losetup', '--find', '--show', *(['--read-only'] if disk_info.readonly else []), *args]
+        disk = str(disk_info.flat_mounted_disk)
+        if direct_io:
+            try:
+                return Path(run_process([*losetup_args, '--direct-io=on', disk]).decode().strip('\n'))
+            except DiskVmError:
+                # Option is not supported by older losetup versions
+                logging.debug(f'Could not set up loop device with direct I/O for {disk_info}')
+        return Path(run_process([*losetup_args, disk]).decode().strip('\n'))
+
+    def _losetup_partscan(self, disk_info: DiskInfo, direct_io: bool) -> tuple[Path, dict[tuple[int, int], Path]]:
+        """
+        Set up one loop device for the whole disk and let the kernel scan its partition table.
+        Returns the loop device and its partition devices by (offset, size) in bytes.
+        """
+        loop_dev = self._losetup(disk_info, ['--partscan'], direct_io=direct_io)
+
+        partition_devices = {}
+        for sys_part in Path('/sys/class/block', loop_dev.name).glob(f'{loop_dev.name}p*'):
+            try:
+                # Always in 512 byte units, independent of the logical sector size
+                start = int((sys_part / 'start').read_text()) * 512
+                size = int((sys_part / 'size').read_text()) * 512
+            except (OSError, ValueError):
+                continue
+            partition_devices[(start, size)] = Path('/dev') / sys_part.name
+
+        # The sysfs entries exist when losetup returns, but udev creates the device nodes asynchronously
+        missing = [d for d in partition_devices.values() if not stat_path(d).is_block_device]
+        if missing:
+            try:
+                run_process(['udevadm', 'settle', f'--timeout={self.PARTITION_DEVICE_TIMEOUT}'])
+            except DiskVmError:
+                logging.debug('Could not wait for udev events')
+            deadline = time.monotonic() + self.PARTITION_DEVICE_TIMEOUT
+            while (missing := [d for d in missing if not stat_path(d).is_block_device]) and time.monotonic() < deadline:
+                time.sleep(0.05)
+        return loop_dev, {k: d for k, d in partition_devices.items() if d not in missing}
+
+    def _losetup_partition(self, disk_info: DiskInfo, offset: int, size: int, direct_io: bool) -> Path:
+        """
+        Set up a loop device for a partition. Thread-safe.
+        """
+        return self._losetup(disk_info, ['--offset', str(offset), '--sizelimit', str(size)], direct_io=direct_io)
+
+    def _register_partition_info(self, disk_info: DiskInfo, loop_dev: Path, offset: int, size: int,
+                                 volume_type: Any, volume_info: Optional[Any], ctx: DiskVmCreatorContext,
+                                 partition_of: Optional[Path] = None):
         volume_info = VolumeInfo(
             disk_info=disk_info, flat_mount=loop_dev, filesystem_mount=None, parent=None,
             offset=offset, size=size, volume_type=volume_type, volume_info=volume_info,
+            # Partition devices of a partition-scanned loop device are removed with the disk loop device
+            additional_info={'loop': {'partition_of': partition_of} if partition_of else {'device': loop_dev}},
         )
         volume_info.disk_info.volumes.append(volume_info)
+        self._dispatch_new_volume(volume_info, ctx=ctx)
 
-        self.plugins.dispatch_all('mounted_volume', volume_info=volume_info, ctx=ctx)
+    def _dispatch_new_volume(self, volume_info: VolumeInfo, ctx: DiskVmCreatorContext):
+        dispatch_all = self.plugins.dispatch_all
+        dispatch_all('mounted_volume', volume_info=volume_info, ctx=ctx)
         if not volume_info.disk_info.readonly:
-            self.plugins.dispatch_all('modify_volume', volume_info=volume_info, ctx=ctx)
+            dispatch_all('modify_volume', volume_info=volume_info, ctx=ctx)
+            self._invalidate_modified_volume(volume_info)
+
+    @staticmethod
+    def _invalidate_modified_volume(volume_info: VolumeInfo):
+        # Plugins might have modified volume headers or the disk containing the volume
+        plugin_utils.invalidate_head(volume_info.flat_mount)
+        plugin_utils.invalidate_head(volume_info.disk_info.flat_mounted_disk)
 
     def _mount_partitions(self, disk_info: DiskInfo, ctx: DiskVmCreatorContext):
         logging.info(f'Mounting partitions of {disk_info}')
 
+        # (offset, size, volume_type, volume_info)
+        partitions = []
         if disk_info.partition_scheme == PartitionScheme.GPT:
             for p in disk_info.disk_info.gpt.partitions:
-                self._add_partition_info(
-                    disk_info=disk_info,
-                    offset=p.first_lba * disk_info.sector_size,
-                    size=(p.last_lba - p.first_lba + 1) * disk_info.sector_size,
-                    volume_type=p.guid,
-                    volume_info=p,
-                    ctx=ctx
-                )
+                partitions.append((
+                    p.first_lba * disk_info.sector_size,
+                    (p.last_lba - p.first_lba + 1) * disk_info.sector_size,
+                    p.guid,
+                    p,
+                ))
         elif disk_info.partition_scheme == PartitionScheme.MBR:
             for p in disk_info.disk_info.mbr.partitions:
-                self._add_partition_info(
-                    disk_info=disk_info,
-                    offset=p.lba * disk_info.sector_size,
-                    size=p.sectors * disk_info.sector_size,
-                    volume_type=p.type,
-                    volume_info=p,
-                    ctx=ctx
-                )
+                partitions.append((
+                    p.lba * disk_info.sector_size,
+                    p.sectors * disk_info.sector_size,
+                    p.type,
+                    p,
+                ))
+        if not partitions:
+            return
+
+        direct_io = ctx.options.loop_direct_io
+
+        # Use the partition devices of a single partition-scanned loop device where the kernel found
+        # the same partitions, instead of setting up one loop device per partition
+        partition_devices = {}
+        try:
+            disk_loop_dev, partition_devices = self._losetup_partscan(disk_info, direct_io=direct_io)
+            if any((offset, size) in partition_devices for offset, size, _, _ in partitions):
+                disk_info.additional_info['loop'] = {'device': disk_loop_dev}
+            else:
+                run_process(['losetup', '--detach', str(disk_loop_dev)])
+                partition_devices = {}
+        except DiskVmError:
+            logging.debug(f'Could not scan partitions of {disk_info} with a loop device')
+        disk_loop_dev = disk_info.additional_info.get('loop', {}).get('device')
+
+        # Set up loop devices for the remaining partitions in parallel
+        remaining = [(offset, size) for offset, size, _, _ in partitions if (offset, size) not in partition_devices]
+        futures = {}
+        if remaining:
+            with ThreadPoolExecutor(max_workers=min(len(remaining), 8)) as executor:
+                futures = {(offset, size): executor.submit(self._losetup_partition, disk_info=disk_info, offset=offset,
+                                                           size=size, direct_io=direct_io)
+                           for offset, size in remaining}
+
+        # Register partitions and dispatch plugins serially in partition order.
+        # After an error, the loop devices of the remaining partitions are detached instead.
+        error = None
+        for offset, size, volume_type, volume_info in partitions:
+            try:
+                if part_dev := partition_devices.get((offset, size)):
+                    if not error:
+                        self._register_partition_info(disk_info=disk_info, loop_dev=part_dev, offset=offset, size=size,
+                                                      volume_type=volume_type, volume_info=volume_info, ctx=ctx,
+                                                      partition_of=disk_loop_dev)
+                    continue
+
+                loop_dev = futures[(offset, size)].result()
+                if error:
+                    run_process(['losetup', '--detach', str(loop_dev)])
+                    continue
+                self._register_partition_info(disk_info=disk_info, loop_dev=loop_dev, offset=offset, size=size,
+                                              volume_type=volume_type, volume_info=volume_info, ctx=ctx)
+            except Exception as ex:
+                error = error or ex
+        if error:
+            raise error
 
     def _mount_filesystems(self, disk_info: DiskInfo, ctx: DiskVmCreatorContext):
         logging.info(f'Mounting filesystems of {disk_info}')
 
+        # Bound once, called for every volume
+        dispatch_all = self.plugins.dispatch_all
+        dispatch_until_result = self.plugins.dispatch_until_result
+        readonly = disk_info.readonly
+        volumes = disk_info.volumes
+
         idx = 0
-        while idx < len(disk_info.volumes):
-            p = disk_info.volumes[idx]
+        while idx < len(volumes):
+            p = volumes[idx]
             if p.flat_mount:
-                res = self.plugins.dispatch_until_result('mount', volume_info=p, ctx=ctx)
+                res = dispatch_until_result('mount', volume_info=p, ctx=ctx)
                 if isinstance(res, VolumeInfo):
                     res = [res]
                 if isinstance(res, Path):
                     # Filesystem mounted
                     p.filesystem_mount = res
-                    self.plugins.dispatch_all('mounted_filesystem', volume_info=p, ctx=ctx)
-                    if not disk_info.readonly:
-                        self.plugins.dispatch_all('modify_filesystem', volume_info=p, ctx=ctx)
+                    dispatch_all('mounted_filesystem', volume_info=p, ctx=ctx)
+                    if not readonly:
+                        dispatch_all('modify_filesystem', volume_info=p, ctx=ctx)
                 elif isinstance(res, list):
                     # New (virtual) volumes discovered
                     for new_p in res:
                         if not new_p.parent:
                             new_p.parent = p
+                        new_p.depth = new_p.parent.depth + 1
                         if not new_p.size:
                             new_p.size = size_blockdevice(new_p.flat_mount)
-                        disk_info.volumes.append(new_p)
-
-                        self.plugins.dispatch_all('mounted_volume', volume_info=new_p, ctx=ctx)
-                        if not disk_info.readonly:
-                            self.plugins.dispatch_all('modify_volume', volume_info=new_p, ctx=ctx)
+                        volumes.append(new_p)
+                        self._dispatch_new_volume(new_p, ctx=ctx)
                 else:
                     # Could not mount
                     logging.warning(f'Could not mount filesystem on volume {p}')
@@ -242,14 +409,16 @@ class DiskVmCreator:
         self._validate_options(options=options)
         ctx = self._create_context(options=options)
         with ctx.mount_contexts:
+            # Run last, after all disks were unmounted
+            ctx.mount_contexts.callback(ctx.mount_point_pool.close)
             ctx.vm = self._create_vm(ctx=ctx)
 
             # Create initial snapshot to not accidentally modify disk images
             ctx.vm.snapshot('Initial')
 
-            # Modify disk
-            for d in ctx.vm.disks:
-                with self.mount_disk(disk=d, readonly=False, ctx=ctx) as disk_info:
+            # Modify disks
+            with self.mount_disks(disks=ctx.vm.disks, readonly=False, ctx=ctx) as disk_infos:
+                for disk_info in disk_infos:
                     with self.mount_partitions_and_filesystems(disk_info=disk_info, ctx=ctx):
                         # modify_* plugin hooks called during mounting
                         logging.info(f'Changes to virtual disk done {disk_info}')
@@ -260,6 +429,5 @@ class DiskVmCreator:
                 # Start VM
                 ctx.vm.start()
                 # Wait until finished
-                while ctx.vm.is_running():
-                    time.sleep(5)
+                ctx.vm.wait()
 
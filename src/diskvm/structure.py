@@ -1,7 +1,9 @@
 import dataclasses
 import enum
+import functools
+import operator
 import struct
-from typing import NewType
+from typing import NewType, Callable
 
 Uint8 = NewType('Uint8', int)
 Uint16 = NewType('Uint16', int)
@@ -31,6 +33,7 @@ class Structure:
     }
 
     @classmethod
+    @functools.cache
     def _get_struct_format(cls):
         out = '<' if cls.endian == Endian.LITTLE else '>'
         for f in dataclasses.fields(cls):
@@ -42,10 +45,35 @@ class Structure:
                 raise Exception(f'Unsupported Type in Structure: {f.type}')
         return out
 
+    @classmethod
+    @functools.cache
+    def _get_struct(cls) -> struct.Struct:
+        # Format only depends on the class: compile it once
+        return struct.Struct(cls._get_struct_format())
+
+    @classmethod
+    @functools.cache
+    def _get_field_names(cls) -> tuple[str, ...]:
+        return tuple(f.name for f in dataclasses.fields(cls))
+
+    @classmethod
+    @functools.cache
+    def _get_field_values(cls) -> Callable[['Structure'], tuple]:
+        # Shallow replacement for dataclasses.astuple, which deep-copies all values
+        names = cls._get_field_names()
+        if len(names) >= 2:
+            return operator.attrgetter(*names)
+        # attrgetter returns a bare value for a single name and requires at least one name
+        return lambda self: tuple(getattr(self, n) for n in names)
+
+    @classmethod
+    def struct_size(cls) -> int:
+        return cls._get_struct().size
+
     def pack(self):
-        return struct.pack(self._get_struct_format(), *dataclasses.astuple(self))
+        return self._get_struct().pack(*self._get_field_values()(self))
 
     @classmethod
     def unpack(cls, data):
-        values = struct.unpack(cls._get_struct_format(), data)
-        return cls(**dict(zip(map(lambda f: f.name, dataclasses.fields(cls)), values)))  # noqa
+        values = cls._get_struct().unpack(data)
+        return cls(**dict(zip(cls._get_field_names(), values)))
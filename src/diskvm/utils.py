@@ -1,13 +1,21 @@
+import collections
 import contextlib
-import itertools
+import fcntl
 import logging
+import operator
 import os
+import queue
 import re
+import stat
+import struct
 import subprocess
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import IntEnum
 from pathlib import Path
+from typing import NamedTuple, Optional
 
 import click
 
@@ -30,13 +38,17 @@ def size(num: int, unit: SizeUnit):
 
 
 def groupby(lst, key, reverse=False):
-    return list(map(lambda g: (g[0], list(g[1])), itertools.groupby(sorted(lst, key=key, reverse=reverse), key=key)))
+    # Bucket items in one pass (key is called once per item), only the distinct keys are sorted
+    buckets = collections.defaultdict(list)
+    for item in lst:
+        buckets[key(item)].append(item)
+    return sorted(buckets.items(), key=operator.itemgetter(0), reverse=reverse)
 
 
-def run_process(args: list[str], stderr=False):
+def run_process(args: list[str], stderr=False, pass_fds=()):
     try:
         logging.debug(f'Running subprocess {args}')
-        proc = subprocess.run(args=args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        proc = subprocess.run(args=args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, pass_fds=pass_fds)
         logging.debug(f'Finished subprocess {args} stdout="{proc.stdout}" stderr="{proc.stderr}"')
         if stderr:
             return proc.stdout, proc.stderr
@@ -57,6 +69,113 @@ def temp_dir():
         tmp_dir.rmdir()
 
 
+class MountPointPool:
+    """
+    Empty files used as bind mount targets. Files are re-used once unmounted instead of
+    creating and deleting a temporary file for each mount. Thread-safe.
+    """
+
+    def __init__(self, base_dir: Optional[Path] = None):
+        # tmpfs: creating the files does not touch the disk
+        self.base_dir = base_dir or (Path('/dev/shm') if os.path.isdir('/dev/shm') else None)
+        self._dir: Optional[Path] = None
+        self._free: queue.SimpleQueue[Path] = queue.SimpleQueue()
+        self._all: list[Path] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> Path:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._dir is None:
+                self._dir = Path(tempfile.mkdtemp(prefix=f'diskvm-{os.getpid()}-', dir=self.base_dir))
+            mount_point = self._dir / f'mount{len(self._all)}'
+            mount_point.touch(exist_ok=False)
+            self._all.append(mount_point)
+            return mount_point
+
+    def put(self, mount_point: Path):
+        """
+        Return an unmounted mount point to the pool
+        """
+        self._free.put(mount_point)
+
+    def close(self):
+        """
+        Remove all mount point files. Files that are still mounted are skipped.
+        """
+        with self._lock:
+            for mount_point in self._all:
+                try:
+                    mount_point.unlink()
+                except OSError:
+                    logging.warning(f'Could not remove mount point {mount_point}')
+            self._all.clear()
+            self._free = queue.SimpleQueue()
+            if self._dir is not None:
+                try:
+                    self._dir.rmdir()
+                    self._dir = None
+                except OSError:
+                    pass
+
+
+class MemoryFile(NamedTuple):
+    path: str
+    fd: int
+
+
+@contextlib.contextmanager
+def memory_file(name: str, data: bytes):
+    """
+    Store data (e.g. key material) in an anonymous in-memory file instead of the filesystem.
+    Subprocesses can only access the file when its fd is passed to run_process(pass_fds=...).
+    """
+    fd = os.memfd_create(name, os.MFD_CLOEXEC)
+    try:
+        os.write(fd, data)
+        yield MemoryFile(path=f'/proc/self/fd/{fd}', fd=fd)
+    finally:
+        os.close(fd)
+
+
+class PathStat(NamedTuple):
+    exists: bool
+    is_dir: bool
+    is_file: bool
+    is_block_device: bool
+    is_mount: bool
+
+
+def stat_path(path: Path, parent_dev: Optional[int] = None) -> PathStat:
+    """
+    Get file type and mount point status of a path with one stat call (two for directories)
+    instead of separate Path.exists(), is_dir(), is_file(), is_block_device() and is_mount() calls.
+    If the device of the parent directory was recorded before mounting (parent_dev), the parent is not stat'ed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return PathStat(exists=False, is_dir=False, is_file=False, is_block_device=False, is_mount=False)
+
+    is_dir = stat.S_ISDIR(st.st_mode)
+    is_mount = False
+    if is_dir and parent_dev is not None:
+        is_mount = st.st_dev != parent_dev
+    elif is_dir:
+        try:
+            parent = os.stat(os.path.join(path, '..'))
+            # Mount points are on a different device than their parent (or are the root directory)
+            is_mount = parent.st_dev != st.st_dev or parent.st_ino == st.st_ino
+        except OSError:
+            pass
+    return PathStat(exists=True, is_dir=is_dir, is_file=stat.S_ISREG(st.st_mode), is_block_device=stat.S_ISBLK(st.st_mode),
+                    is_mount=is_mount)
+
+
 def retry(num, sleep=1):
     def _inner(func):
         def _wrapped(*args, **kwargs):
@@ -72,21 +191,67 @@ def retry(num, sleep=1):
     return _inner
 
 
+def find_first(func, items, cleanup=None, max_workers=8):
+    """
+    Call func for all items in parallel and return the tuple (item, result) of the first truthy result.
+    Truthy results of other calls that finished concurrently are passed to cleanup.
+    Calls that raise an exception are treated like falsy results.
+    """
+    items = list(items)
+    if not items:
+        return None
+
+    found = None
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = {executor.submit(func, i): i for i in items}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                res = future.result()
+            except Exception:
+                logging.exception('Trial failed')
+                continue
+            if not res:
+                continue
+            if found is None:
+                found = (futures[future], res)
+                # Do not start remaining trials
+                for f in futures:
+                    f.cancel()
+            elif cleanup:
+                cleanup(res)
+    return found
+
+
+# ioctl request to get the size of a block device in bytes (u64)
+BLKGETSIZE64 = 0x80081272
+
+
 def size_blockdevice(file_or_device):
     """
     Find size of file or block device in bytes
     """
+    st = os.stat(file_or_device)
+    if not stat.S_ISBLK(st.st_mode):
+        return st.st_size
+
     with open(file_or_device, 'rb') as f:
-        return f.seek(0, os.SEEK_END)
+        try:
+            return struct.unpack('=Q', fcntl.ioctl(f.fileno(), BLKGETSIZE64, b'\x00' * 8))[0]
+        except OSError:
+            return f.seek(0, os.SEEK_END)
 
 
 class ChoiceMap(click.Choice):
     def __init__(self, choices: dict):
         self.choice_map = choices
+        # Values (e.g. lists of plugins) are not necessarily hashable: compare by identity
+        self._value_ids = {id(v) for v in self.choice_map.values()}
         super().__init__(choices=self.choice_map.keys(), case_sensitive=False)
 
     def convert(self, value, param, ctx):
-        if value in self.choice_map.values():
+        if id(value) in self._value_ids:
             return value
         return self.choice_map[super().convert(value=value, param=param, ctx=ctx)]
 
@@ -103,12 +268,14 @@ class BytesParamType(click.types.StringParamType):
 
 class SizeParamType(click.ParamType):
     name = 'size'
-    PATTERN = re.compile(r'([0-9]+)([KMGT]?B?)')
+    PATTERN = re.compile(r'(?P<num>[0-9]+)\s*(?P<unit>[KMGT]?B?)', re.IGNORECASE | re.ASCII)
+    # Unit suffixes with and without "B"
+    UNITS = {u.name: u.value for u in SizeUnit} | {u.name[:-1]: u.value for u in SizeUnit if len(u.name) > 1} | {'': SizeUnit.B.value}
 
     def convert(self, value, param, ctx) -> int:
         if isinstance(value, int):
             return value
         elif m := self.PATTERN.fullmatch(value):
-            return int(m.group(1)) * SizeUnit[m.group(2) if m.group(2).endswith('B') else m.group(2) + 'B']
+            return int(m['num']) * self.UNITS[m['unit'].upper()]
         else:
             self.fail(message=f'"{value}" is not a valid size', param=param, ctx=ctx)
@@ -1,15 +1,17 @@
 import abc
+import bisect
 import copy
 import dataclasses
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
-from functools import cached_property
 from pathlib import Path
 from typing import Type, Optional
 
 from diskvm.errors import UnsupportedDiskTypeError, InvalidDiskPartError, VirtualizationSoftwareNotAvailable
-from diskvm.utils import SizeUnit
+from diskvm.utils import SizeUnit, stat_path
 
 
 class FirmwareType(Enum):
@@ -61,48 +63,41 @@ class VirtualDiskBuilder(abc.ABC):
         """
         Add a part of the virtual disk (e.g. header, volume) stored in an external file
         """
-        if not part.source_file.is_file() and not part.source_file.is_block_device():
+        source_stat = stat_path(part.source_file)
+        if not source_stat.is_file and not source_stat.is_block_device:
             raise InvalidDiskPartError(part, "Invalid file")
         if part.target_offset % self.sector_size != 0 or (part.target_offset + part.length) % self.sector_size != 0:
             raise InvalidDiskPartError(part, "Not aligned to sectors")
 
         # Merge disk parts
-        for p in list(self.disk_parts):
-            if (p.target_offset < part.target_offset and p.target_offset + p.length <= part.target_offset) or \
-                    (p.target_offset >= part.target_offset + part.length):
-                # No overlapping areas
-                pass
-            elif p.target_offset >= part.target_offset and p.target_offset + p.length <= part.target_offset + part.length:
-                # p:    | _____ | _aaa_ | _____ |
-                # part: | _____ | bbbbb | _____ |
-                # Completely replace part
-                self.disk_parts.remove(p)
-            elif p.target_offset < part.target_offset < p.target_offset + p.length <= part.target_offset + part.length:
-                # p:    | __aaa | aa___ | _____ |
-                # part: | _____ | bbbbb | _____ |
-                overlap_len = (p.target_offset + p.length) - part.target_offset
-                p.length -= overlap_len
-            elif part.target_offset < p.target_offset < part.target_offset + part.length < p.target_offset + p.length:
-                # p:    | _____ | __aaa | aaa__ |
-                # part: | _____ | bbbbb | _____ |
-                overlap_len = (p.target_offset + p.length) - (part.target_offset + part.length)
-                p.target_offset += overlap_len
-                p.source_offset += overlap_len
-                p.length -= overlap_len
-            elif p.target_offset < part.target_offset and p.target_offset + p.length > part.target_offset + part.length:
-                # p:    | ___aa | aaaaa | aa___ |
-                # part: | _____ | bbbbb | _____ |
-                p2 = copy.copy(p)
-
-                p.length = part.target_offset - p.target_offset
-
-                p2.length = (p2.target_offset + p2.length) - (part.target_offset + part.length)
-                p2.target_offset = part.target_offset + part.length
-                p2.source_offset += p.length + part.length
-                self.disk_parts.append(p2)
-
-        self.disk_parts.append(part)
-        self.disk_parts.sort(key=lambda p: p.target_offset)
+        # disk_parts is sorted and non-overlapping, i.e. sorted by start and end offsets:
+        # only the parts between the first one ending after the start of part and the last one starting before its end overlap
+        part_end = part.target_offset + part.length
+        first = bisect.bisect_right(self.disk_parts, part.target_offset, key=lambda p: p.target_offset + p.length)
+        last = bisect.bisect_left(self.disk_parts, part_end, lo=first, key=lambda p: p.target_offset)
+
+        # p:    | _____ | _aaa_ | _____ |
+        # part: | _____ | bbbbb | _____ |
+        # Overlapping parts are replaced completely, only the first and last one can reach beyond part
+        overlapping = self.disk_parts[first:last]
+        new_parts = []
+        if overlapping and (head := overlapping[0]).target_offset < part.target_offset:
+            # p:    | __aaa | aa___ | _____ |
+            # part: | _____ | bbbbb | _____ |
+            head = copy.copy(head)
+            head.length = part.target_offset - head.target_offset
+            new_parts.append(head)
+        new_parts.append(part)
+        if overlapping and (tail := overlapping[-1]).target_offset + tail.length > part_end:
+            # p:    | _____ | __aaa | aaa__ |
+            # part: | _____ | bbbbb | _____ |
+            tail = copy.copy(tail)
+            overlap_len = part_end - tail.target_offset
+            tail.target_offset += overlap_len
+            tail.source_offset += overlap_len
+            tail.length -= overlap_len
+            new_parts.append(tail)
+        self.disk_parts[first:last] = new_parts
 
     @abc.abstractmethod
     def write(self, out_dir: Path) -> VirtualDisk:
@@ -122,6 +117,12 @@ class VirtualMachine(abc.ABC):
     def is_running(self):
         return self.virtualization_software.is_running(self)
 
+    def wait(self):
+        """
+        Block until the VM is not running anymore
+        """
+        return self.virtualization_software.wait(self)
+
     def snapshot(self, name=None):
         logging.info(f'Creating VM snapshot. name={name}')
         return self.virtualization_software.snapshot(self, name=name)
@@ -169,10 +170,29 @@ class VirtualizationSoftware(abc.ABC):
     def name(self) -> str:
         pass
 
-    @cached_property
+    # Results of check_available() by class, shared by all instances of the process
+    _availability: dict[type, Optional[VirtualizationSoftwareNotAvailable]] = {}
+
+    def ensure_available(self, force=False):
+        """
+        Check if virtualization software is installed on the host system.
+        The check only runs once per process, unless forced.
+        :raise VirtualizationSoftwareNotAvailable
+        """
+        cls = type(self)
+        if force or cls not in VirtualizationSoftware._availability:
+            try:
+                self.check_available()
+                VirtualizationSoftware._availability[cls] = None
+            except VirtualizationSoftwareNotAvailable as ex:
+                VirtualizationSoftware._availability[cls] = ex
+        if (ex := VirtualizationSoftware._availability[cls]) is not None:
+            raise ex
+
+    @property
     def is_available(self) -> bool:
         try:
-            self.check_available()
+            self.ensure_available()
             return True
         except VirtualizationSoftwareNotAvailable:
             return False
@@ -193,6 +213,16 @@ class VirtualizationSoftware(abc.ABC):
     def is_running(self, vm: VirtualMachine):
         pass
 
+    def wait(self, vm: VirtualMachine, min_interval: float = 1, max_interval: float = 30):
+        """
+        Wait until the VM is not running anymore.
+        Polls is_running() with exponential backoff. Override if the virtualization software supports waiting natively.
+        """
+        interval = min_interval
+        while self.is_running(vm):
+            time.sleep(interval)
+            interval = min(2 * interval, max_interval)
+
     @abc.abstractmethod
     def snapshot(self, vm: VirtualMachine, name: Optional[str] = None):
         pass
@@ -205,6 +235,50 @@ class VirtualizationSoftware(abc.ABC):
     def unmount_disk(self, disk: VirtualDisk):
         pass
 
+    def mount_disks(self, disks: list[VirtualDisk], readonly=True) -> list[Path]:
+        """
+        Mount multiple disks in parallel. Returns the flat disk paths in order of disks.
+        If mounting a disk fails, the other disks are unmounted again and the first mount error is raised.
+        """
+        if not disks:
+            return []
+        with ThreadPoolExecutor(max_workers=min(8, len(disks))) as executor:
+            futures = [executor.submit(self.mount_disk, d, readonly=readonly) for d in disks]
+
+        if error := next((f.exception() for f in futures if f.exception() is not None), None):
+            mounted = [(d, f.result()) for d, f in zip(disks, futures) if f.exception() is None]
+            try:
+                self.unmount_disks([d for d, _ in mounted], flat_disks=[flat_disk for _, flat_disk in mounted])
+            except Exception:
+                logging.exception('Could not unmount disks after a failed mount')
+            raise error
+        return [f.result() for f in futures]
+
+    def unmount_disks(self, disks: list[VirtualDisk], flat_disks: Optional[list[Path]] = None):
+        """
+        Unmount multiple disks in parallel. All disks are unmounted even if some fail.
+        If the flat disk paths returned by mount_disks() are passed, their mount directories are removed as well.
+        The first error is raised after all disks were cleaned up.
+        """
+        if not disks:
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(disks))) as executor:
+            futures = [executor.submit(self.unmount_disk, d) for d in disks]
+
+        errors = []
+        for i, f in enumerate(futures):
+            if f.exception() is not None:
+                errors.append(f.exception())
+            elif flat_disks is not None:
+                try:
+                    flat_disks[i].parent.rmdir()
+                except OSError as ex:
+                    errors.append(ex)
+        for ex in errors[1:]:
+            logging.error('Could not unmount disk', exc_info=ex)
+        if errors:
+            raise errors[0]
+
     @abc.abstractmethod
     def builder(self, name: str) -> VirtualMachineBuilder:
         pass
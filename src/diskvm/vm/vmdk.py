@@ -1,5 +1,6 @@
-import math
+import os
 from pathlib import Path
+from typing import Optional
 
 from diskvm.vm.base import VirtualDisk, DiskType, VirtualDiskBuilder
 
@@ -17,55 +18,77 @@ class VmdkBuilder(VirtualDiskBuilder):
         return 'ide' if self.type == DiskType.IDE else \
                'lsilogic'
 
+    def _extents(self) -> list[tuple[int, Optional[Path], int]]:
+        """
+        Extents (sectors, source file or None for zeros, source offset in sectors) of the disk parts.
+        Adjacent zero extents and contiguous extents of the same file are merged.
+        """
+        extents = []
+
+        def add_extent(num_sectors, source_file, source_sector):
+            if extents:
+                prev_sectors, prev_file, prev_source_sector = extents[-1]
+                if prev_file == source_file and (source_file is None or prev_source_sector + prev_sectors == source_sector):
+                    extents[-1] = (prev_sectors + num_sectors, prev_file, prev_source_sector)
+                    return
+            extents.append((num_sectors, source_file, source_sector))
+
+        current_sector = 0
+        for p in self.disk_parts:
+            # Unallocated space
+            if current_sector * self.sector_size != p.target_offset:
+                num_padding_sectors = (p.target_offset // self.sector_size) - current_sector
+                current_sector += num_padding_sectors
+                add_extent(num_padding_sectors, None, 0)
+
+            # Add file
+            size_in_sectors = p.length // self.sector_size
+            current_sector += size_in_sectors
+            add_extent(size_in_sectors, p.source_file, 0 if p.source_file is None else p.source_offset // self.sector_size)
+        return extents
+
     def write(self, out_dir: Path) -> VirtualDisk:
         # VMDK specification: https://www.vmware.com/support/developer/vddk/vmdk_50_technote.pdf
         out_path = out_dir / (self.name + '.vmdk')
         with open(out_path, 'w') as f:
-            vmdk = []
-            vmdk.extend([
+            f.write('\n'.join([
                 '# Disk Descriptor File',
                 'version=1',
                 'CID=fffffffe',  # Newly created base disk
                 'parentCID=ffffffff',  # No parent disk
                 f'createType="monolithicFlat"',
                 '',
-            ])
+                '# Extent description',
+            ]) + '\n')
 
             # Add disk parts from external files
-            vmdk.append('# Extent description')
+            # Written line by line (buffered by the file) instead of collecting all extents first
+            # Paths as strings: cheaper than Path operations for each extent
+            cwd = os.getcwd()
+            out_dir_prefix = os.path.join(os.path.abspath(out_dir), '')
             current_sector = 0
-            for p in self.disk_parts:
-                # Unallocated space
-                if current_sector * self.sector_size != p.target_offset:
-                    num_padding_sectors = (p.target_offset // self.sector_size) - current_sector
-                    current_sector += num_padding_sectors
-                    vmdk.append(f'RW {num_padding_sectors} ZERO')
-
-                # Add file
-                size_in_sectors = p.length // self.sector_size
-                current_sector += size_in_sectors
-                if p.source_file is None:
-                    vmdk.append(f'RW {size_in_sectors} ZERO')
+            for num_sectors, source_file, source_sector in self._extents():
+                current_sector += num_sectors
+                if source_file is None:
+                    f.write(f'RW {num_sectors} ZERO\n')
                 else:
                     # Relative path if possible
-                    path = p.source_file.absolute()
-                    if p.source_file.is_relative_to(out_dir):
-                        p = p.source_file.relative_to(out_dir)
-                    vmdk.append(f'RW {size_in_sectors} FLAT "{path}" {p.source_offset // self.sector_size}')
-
-            # RW <sectors> ZERO
-            vmdk.append('')
+                    path = os.path.join(cwd, source_file)
+                    if path.startswith(out_dir_prefix):
+                        path = path[len(out_dir_prefix):]
+                    f.write(f'RW {num_sectors} FLAT "{path}" {source_sector}\n')
 
             # Disk properties
-            vmdk.extend([
+            f.write('\n'.join([
+                '',
                 '# DDB - Disk Data Base',
                 f'ddb.adapterType="{self.adapter_type}"',
                 f'ddb.geometry.sectors="{self.NUM_SECTORS}"',
                 f'ddb.geometry.heads="{self.NUM_CYLINDERS}"',
-                f'ddb.geometry.cylinders="{math.ceil(current_sector / (self.NUM_CYLINDERS * self.NUM_SECTORS))}"',
+                # Integer ceil division
+                f'ddb.geometry.cylinders="{-(-current_sector // (self.NUM_CYLINDERS * self.NUM_SECTORS))}"',
                 'ddb.virtualHWVersion="18"',  # VMware Workstation/Player 16.x
-            ])
-            f.write('\n'.join(vmdk))
+            ]))
 
         return VirtualDisk(self.virtualization_software, path=out_path, type=self.type)
 
@@ -1,5 +1,8 @@
+import mmap
+import os
 import re
 import tempfile
+import time
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
@@ -12,13 +15,85 @@ from diskvm.vm.base import VirtualMachineBuilder, VirtualizationSoftware, Virtua
 from diskvm.vm.vmdk import VmdkBuilder
 
 
+# Alternation of VMX disk adapter prefixes, e.g. "ide|sata|nvme"
+_DISK_TYPE_ALT = '|'.join(t.value for t in DiskType)
+
+# VMX specification: http://sanbarrow.com/vmx.html
+# Filled in once per VM with str.format. Comment lines are VMX comments.
+_VMX_TEMPLATE = """\
+# Static Values
+.encoding = "UTF-8"
+config.version = "8"
+# VMware Workstation/Player 16.x
+virtualHW.version = "18"
+displayName = "{name}"
+
+# Memory and CPUs
+memsize = "{memsize}"
+numvcpus = "{cpus}"
+cpuid.coresPerSocket = "1"
+
+# Firmware
+firmware = "{firmware}"
+
+# Network adapter (disabled by default)
+ethernet0.present = "TRUE"
+ethernet0.startConnected = "FALSE"
+ethernet0.connectionType = "nat"
+ethernet0.addressType = "generated"
+
+# Set time and disable time sync
+rtc.starttime = "{rtc_start}"
+tools.syncTime = "FALSE"
+time.synchronize.continue = "FALSE"
+time.synchronize.restore = "FALSE"
+time.synchronize.resume.disk = "FALSE"
+time.synchronize.resume.memory = "FALSE"
+time.synchronize.shrink = "FALSE"
+time.synchronize.tools.startup = "FALSE"
+# Prevent user from enabling time synchronization
+isolation.tools.setOption.disable = "TRUE"
+
+# Disable snapshots on VMware Workstation to prevent accidental modification of original image
+snapshot.disabled = "TRUE"
+
+floppy0.present = "FALSE"
+
+# PCI bridge for PCIe support (required for NVMe)
+# https://communities.vmware.com/t5/VMware-Workstation-Pro/NO-PCIe-PCI-slots-available-when-attempting-to-add-a-NIC-to-a/td-p/2823330
+pciBridge0.present = "TRUE"
+pciBridge4.present = "TRUE"
+pciBridge4.virtualDev = "pcieRootPort"
+pciBridge4.functions = "8"
+pciBridge5.present = "TRUE"
+pciBridge5.virtualDev = "pcieRootPort"
+pciBridge5.functions = "8"
+pciBridge6.present = "TRUE"
+pciBridge6.virtualDev = "pcieRootPort"
+pciBridge6.functions = "8"
+pciBridge7.present = "TRUE"
+pciBridge7.virtualDev = "pcieRootPort"
+pciBridge7.functions = "8"
+
+# Guest OS
+guestOS = "{guest_os}"
+"""
+
+
 class VmwareVirtualMachine(VirtualMachine):
-    DISK_PATH_PATTERN = re.compile(rf'({"|".join([v.value for v in DiskType])})[0-9]+:[0-9]+\.fileName\s*=\s*"([^"]+)"')
+    _DISK_TYPE_BY_VALUE: dict[bytes, DiskType] = {t.value.encode(): t for t in DiskType}
+    # Matched on the bytes of the (UTF-8 encoded) VMX file, one entry per line
+    DISK_PATH_PATTERN = re.compile(rf'^[ \t]*(?P<type>{_DISK_TYPE_ALT})\d+:\d+\.fileName[ \t]*=[ \t]*"(?P<path>[^"\n]+)"'.encode(), re.MULTILINE | re.ASCII)
 
     def __init__(self, virtualization_software, vmx: Path):
         super().__init__(virtualization_software)
         self.vmx = vmx
 
+    @property
+    def absolute_vmx(self) -> Path:
+        # VMX paths are usually already absolute (out_dir): only call getcwd() if not
+        return self.vmx if self.vmx.is_absolute() else self.vmx.absolute()
+
     @property
     def disks(self) -> list[VirtualDisk]:
         """
@@ -27,12 +102,17 @@ class VmwareVirtualMachine(VirtualMachine):
         and the paths of virtual disks inside the VMX file are updated.
         """
         out = []
-        with open(self.vmx, 'r') as f:
-            for m in self.DISK_PATH_PATTERN.findall(f.read()):
-                path = Path(m[1])
-                if not path.is_absolute():
-                    path = self.vmx.parent / path
-                out.append(VirtualDisk(self.virtualization_software, path=path, type=DiskType(m[0])))
+        with open(self.vmx, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return out
+            # Match directly on the mapped file instead of reading a copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as vmx_data:
+                for m in self.DISK_PATH_PATTERN.finditer(vmx_data):
+                    # Check the string instead of constructing a Path first
+                    path_str = m['path'].decode()
+                    path = Path(path_str) if path_str.startswith('/') else self.vmx.parent / path_str
+                    out.append(VirtualDisk(self.virtualization_software, path=path, type=self._DISK_TYPE_BY_VALUE[m['type']]))
         return out
 
 
@@ -40,68 +120,15 @@ class VMwareVirtualMachineBuilder(VirtualMachineBuilder):
     disk_builder_type = VmdkBuilder
 
     def write(self, out_dir):
-        # VMX specification: http://sanbarrow.com/vmx.html
-        vmx = []
-        vmx.extend([
-            '# Static Values',
-            '.encoding = "UTF-8"',
-            'config.version = "8"',
-            'virtualHW.version = "18"',  # VMware Workstation/Player 16.x
-            f'displayName = "{self.name}"',
-
-            # Memory and CPUs
-            f'memsize = "{self.memory // SizeUnit.MB}"',
-            f'numvcpus = "{self.cpus}"',
-            'cpuid.coresPerSocket = "1"',
-
-            # Firmware
-            f'firmware = "{(self.firmware or FirmwareType.EFI).value}"',
-
-            # Network adapter (disabled by default)
-            'ethernet0.present = "TRUE"',
-            'ethernet0.startConnected = "FALSE"',
-            'ethernet0.connectionType = "nat"',
-            'ethernet0.addressType = "generated"',
-            # 'ethernet0.virtualDev = "e1000e',
-
-            # Set time and disable time sync
-            f'rtc.starttime = "{int(self.time.timestamp())}"',
-            'tools.syncTime = "FALSE"',
-            'time.synchronize.continue = "FALSE"',
-            'time.synchronize.restore = "FALSE"',
-            'time.synchronize.resume.disk = "FALSE"',
-            'time.synchronize.resume.memory = "FALSE"',
-            'time.synchronize.shrink = "FALSE"',
-            'time.synchronize.tools.startup = "FALSE"',
-            # Prevent user from enabling time synchronization
-            'isolation.tools.setOption.disable = "TRUE"',
-
-            # disable snapshots on vmware workstation to prevent accidental modification of original image
-            'snapshot.disabled = "TRUE"',
-
-            'floppy0.present = "FALSE"',
-
-            # PCI bridge for PCIe support (required for NVMe)
-            # https://communities.vmware.com/t5/VMware-Workstation-Pro/NO-PCIe-PCI-slots-available-when-attempting-to-add-a-NIC-to-a/td-p/2823330
-            'pciBridge0.present = "TRUE"',
-            'pciBridge4.present = "TRUE"',
-            'pciBridge4.virtualDev = "pcieRootPort"',
-            'pciBridge4.functions = "8"',
-            'pciBridge5.present = "TRUE"',
-            'pciBridge5.virtualDev = "pcieRootPort"',
-            'pciBridge5.functions = "8"',
-            'pciBridge6.present = "TRUE"',
-            'pciBridge6.virtualDev = "pcieRootPort"',
-            'pciBridge6.functions = "8"',
-            'pciBridge7.present = "TRUE"',
-            'pciBridge7.virtualDev = "pcieRootPort"',
-            'pciBridge7.functions = "8"',
-        ])
-
-        # Guest OS
-        vmx.append(f'guestOS = "{self.guest_os or "other-64"}"')
+        # VM configuration with defaults
+        firmware = (self.firmware or FirmwareType.EFI).value
+        guest_os = self.guest_os or 'other-64'
+        memsize = self.memory // SizeUnit.MB
+        rtc_start = int(self.time.timestamp())
 
         # Virtual disks
+        vmx = []
+        disk_adapters = set()
         for i, db in enumerate(self.disks):
             # Write VMDK file
             d = db.write(out_dir)
@@ -115,19 +142,29 @@ class VMwareVirtualMachineBuilder(VirtualMachineBuilder):
 
             # Add disk adapter once
             disk_adapter = f'{d.type.value}0.present = "TRUE"'
-            if disk_adapter not in vmx:
+            if disk_adapter not in disk_adapters:
+                disk_adapters.add(disk_adapter)
                 vmx.append(disk_adapter)
 
         # Write VMX file
         out_file = out_dir / (self.name + '.vmx')
-        with open(out_file, 'w') as f:
-            f.write('\n'.join(vmx))
+        with open(out_file, 'wb') as f:
+            # Encoding declared in the VMX file (.encoding)
+            f.write((_VMX_TEMPLATE.format(name=self.name, memsize=memsize, cpus=self.cpus, firmware=firmware,
+                                          rtc_start=rtc_start, guest_os=guest_os)
+                     + '\n'.join(vmx)).encode('utf-8'))
 
         return VmwareVirtualMachine(self.virtualization_software, vmx=out_file)
 
 
 class Vmware(VirtualizationSoftware):
     name = "VMwareWorkstation"
+    # Seconds to re-use the output of "vmrun list" for is_running()
+    RUNNING_VMS_TTL = 0.5
+
+    def __init__(self):
+        # (time.monotonic() of the last "vmrun list", paths of running VMs)
+        self._running_vms_cache: tuple[float, set[Path]] = (0.0, set())
 
     def check_available(self):
         try:
@@ -143,19 +180,33 @@ class Vmware(VirtualizationSoftware):
             raise VirtualizationSoftwareNotAvailable() from ex
 
     def start(self, vm: VmwareVirtualMachine):
-        utils.run_process(['vmrun', 'start', str(vm.vmx.absolute()), 'gui'])
+        try:
+            utils.run_process(['vmrun', 'start', os.fspath(vm.absolute_vmx), 'gui'])
+        finally:
+            # Running VMs changed
+            self._running_vms_cache = (0.0, set())
 
     def is_running(self, vm: VmwareVirtualMachine):
-        running_vms = [Path(p) for p in utils.run_process(['vmrun', 'list']).decode().splitlines()[1:]]
-        return vm.vmx in running_vms
+        now = time.monotonic()
+        timestamp, running_vms = self._running_vms_cache
+        if not timestamp or now - timestamp > self.RUNNING_VMS_TTL:
+            # First line is the number of running VMs
+            running_vms = {Path(p) for p in utils.run_process(['vmrun', 'list']).decode().splitlines()[1:]}
+            self._running_vms_cache = (now, running_vms)
+        # VMs are started with their absolute path
+        return vm.absolute_vmx in running_vms
 
     def snapshot(self, vm: VmwareVirtualMachine, name: Optional[str] = None):
         name = name or f'Snapshot {datetime.now().isoformat()}'
-        utils.run_process(['vmrun', 'snapshot', str(vm.vmx.absolute()), name])
+        utils.run_process(['vmrun', 'snapshot', os.fspath(vm.absolute_vmx), name])
 
     def mount_disk(self, disk: VirtualDisk, readonly=True) -> Path:
         mount_dir = Path(tempfile.mkdtemp())
-        utils.run_process(['vmware-mount', *(['-r'] if readonly else []), '-f', str(disk.path), str(mount_dir)])
+        try:
+            utils.run_process(['vmware-mount', *(['-r'] if readonly else []), '-f', str(disk.path), str(mount_dir)])
+        except Exception:
+            mount_dir.rmdir()
+            raise
         return mount_dir / 'flat'
 
     def unmount_disk(self, disk: VirtualDisk):
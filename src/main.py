@@ -1,3 +1,4 @@
+import importlib
 import itertools
 import logging
 import shutil
@@ -7,34 +8,41 @@ import click
 
 from diskvm.utils import ChoiceMap, BytesParamType, SizeParamType
 from diskvm.vm.base import FirmwareType
-from diskvm.plugins.luks import LuksAddPasswordPlugin, LuksOnTheFlyDecryptPlugin
-from diskvm.plugins.os_detect import DetectOperatingSystemPlugin, DetectEfiPlugin
-from diskvm.plugins.password_bypass import WindowsRegistryOverridePasswordPlugin, EtcShadowBlankPasswords
-from diskvm.plugins.veracrypt import VeraCryptOnTheFlyDecryptPlugin, \
-    VeraCryptOverridePasswordPlugin
-from diskvm.plugins.bitlocker import BitLockerOverridePasswordPlugin, BitLockerOnTheFlyDecryptPlugin
 from diskvm.runner import DiskVmCreator, DiskVmCreatorOptions
 from diskvm.vm.vmware import Vmware
 
 
+def lazy_plugins(*plugins: str):
+    """
+    Factory for a list of plugin instances given as "module:class".
+    Plugin modules (and their crypto and registry dependencies) are only imported if the option is selected.
+    """
+    def create_plugins():
+        return [getattr(importlib.import_module(module), cls)() for module, cls in map(lambda p: p.split(':'), plugins)]
+    return create_plugins
+
+
 VIRTUALIZATION_SOFTWARE = {
     'vmware': Vmware(),
 }
 PASSWORD_BYPASS_OPTIONS = {
-    'auto': [EtcShadowBlankPasswords(), WindowsRegistryOverridePasswordPlugin()],
-    'none': [],
-    'linux': [EtcShadowBlankPasswords()],
-    'windows': [WindowsRegistryOverridePasswordPlugin()],
+    'auto': lazy_plugins('diskvm.plugins.password_bypass:EtcShadowBlankPasswords',
+                         'diskvm.plugins.password_bypass:WindowsRegistryOverridePasswordPlugin'),
+    'none': lazy_plugins(),
+    'linux': lazy_plugins('diskvm.plugins.password_bypass:EtcShadowBlankPasswords'),
+    'windows': lazy_plugins('diskvm.plugins.password_bypass:WindowsRegistryOverridePasswordPlugin'),
 }
 FDE_BYPASS_OPTIONS = {
-    'none': [],
-    'auto': [BitLockerOverridePasswordPlugin(), LuksAddPasswordPlugin(), VeraCryptOverridePasswordPlugin()],
-    'bitlocker_otf_mount': [BitLockerOnTheFlyDecryptPlugin()],
-    'bitlocker_add_clearkey': [BitLockerOverridePasswordPlugin()],
-    'luks_add_pw': [LuksAddPasswordPlugin()],
-    'luks_otf_mount': [LuksOnTheFlyDecryptPlugin()],
-    'veracrypt_otf_mount': [VeraCryptOnTheFlyDecryptPlugin()],
-    'veracrypt_overwrite_pw': [VeraCryptOverridePasswordPlugin()],
+    'none': lazy_plugins(),
+    'auto': lazy_plugins('diskvm.plugins.bitlocker:BitLockerOverridePasswordPlugin',
+                         'diskvm.plugins.luks:LuksAddPasswordPlugin',
+                         'diskvm.plugins.veracrypt:VeraCryptOverridePasswordPlugin'),
+    'bitlocker_otf_mount': lazy_plugins('diskvm.plugins.bitlocker:BitLockerOnTheFlyDecryptPlugin'),
+    'bitlocker_add_clearkey': lazy_plugins('diskvm.plugins.bitlocker:BitLockerOverridePasswordPlugin'),
+    'luks_add_pw': lazy_plugins('diskvm.plugins.luks:LuksAddPasswordPlugin'),
+    'luks_otf_mount': lazy_plugins('diskvm.plugins.luks:LuksOnTheFlyDecryptPlugin'),
+    'veracrypt_otf_mount': lazy_plugins('diskvm.plugins.veracrypt:VeraCryptOnTheFlyDecryptPlugin'),
+    'veracrypt_overwrite_pw': lazy_plugins('diskvm.plugins.veracrypt:VeraCryptOverridePasswordPlugin'),
 }
 
 
@@ -42,6 +50,15 @@ def to_path(ctx, param, value: str) -> Path:
     return Path(value)
 
 
+def read_master_keys(f):
+    """
+    Read hex encoded keys line by line. Empty lines and comments (#) are skipped.
+    """
+    for line in f:
+        if (line := line.strip()) and not line.startswith('#'):
+            yield bytes.fromhex(line)
+
+
 @click.command()
 @click.argument('disk_image', required=True, type=click.Path(exists=True, readable=True, file_okay=True, dir_okay=False), callback=to_path)
 @click.option('--out-dir', required=True, type=click.Path(exists=False, writable=True, dir_okay=True, file_okay=False), callback=to_path)
@@ -57,9 +74,10 @@ def to_path(ctx, param, value: str) -> Path:
 @click.option('--master-key', type=BytesParamType(), multiple=True, required=False)
 @click.option('--master-keys-file', type=click.File(mode='r'), required=False, help='File containing possible master keys. One key per line as hex string.')
 @click.option('--xts-combine-keys', type=click.BOOL, default=True, help='Combine each key with every other to build possible XTS mode keys when keys extracted from a memory dump are provided.')
+@click.option('--loop-direct-io/--no-loop-direct-io', is_flag=True, default=True, help='Set up loop devices for partitions with direct I/O')
 @click.option('-v', '--verbose', count=True, default=0)
 def main(disk_image: Path, out_dir: Path, name, start_vm, virtualization_software, vm_memory, vm_cpus, guest_os, firmware,
-         pw_bypass, fde_bypass, master_key, master_keys_file, xts_combine_keys, verbose):
+         pw_bypass, fde_bypass, master_key, master_keys_file, xts_combine_keys, loop_direct_io, verbose):
     # Set up logging
     logging.basicConfig(level=logging.DEBUG if verbose >= 2 else logging.INFO if verbose >= 1 else logging.WARNING)
 
@@ -72,17 +90,22 @@ def main(disk_image: Path, out_dir: Path, name, start_vm, virtualization_softwar
     #         f.unlink()
 
     # Create a list of possible master keys
-    master_keys = set(master_key or [])
+    master_keys: set[bytes] = set(master_key or ())
     if master_keys_file:
-        master_keys |= set(map(bytes.fromhex, filter(None, master_keys_file.read().splitlines())))
+        master_keys.update(read_master_keys(master_keys_file))
     if xts_combine_keys:
         # Combine keys of same length to possible XTS keys
-        master_keys |= set(map(lambda t: t[0] + t[1], filter(lambda t: len(t[0]) == len(t[1]), itertools.permutations(master_keys, 2))))
+        keys_by_length = {}
+        for k in master_keys:
+            keys_by_length.setdefault(len(k), []).append(k)
+        # Only pairs within the same length group, instead of filtering all pairs.
+        # Iterates the groups, not master_keys: the set can be updated directly
+        master_keys.update(a + b for keys in keys_by_length.values() for a, b in itertools.permutations(keys, 2))
 
     # Configure plugins and options from CLI parameters
     creator = DiskVmCreator(virtualization_software)
-    creator.plugins.add(*pw_bypass)
-    creator.plugins.add(*fde_bypass)
+    creator.plugins.add(*pw_bypass())
+    creator.plugins.add(*fde_bypass())
     options = DiskVmCreatorOptions(
         out_dir=out_dir,
         disk_image=disk_image,
@@ -90,15 +113,18 @@ def main(disk_image: Path, out_dir: Path, name, start_vm, virtualization_softwar
         memory=vm_memory,
         num_cpus=vm_cpus,
         start_vm=start_vm,
+        loop_direct_io=loop_direct_io,
         additional_options={
             'master_keys': master_keys,
         }
     )
     if guest_os == 'auto':
+        from diskvm.plugins.os_detect import DetectOperatingSystemPlugin
         creator.plugins.add(DetectOperatingSystemPlugin())
     else:
         options.guest_os = guest_os
     if firmware == 'auto':
+        from diskvm.plugins.os_detect import DetectEfiPlugin
         creator.plugins.add(DetectEfiPlugin())
     else:
         options.firmware = FirmwareType(firmware)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Sources are not installed as a package (main.py is run from src/)
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
@@ -0,0 +1,60 @@
+import io
+import struct
+
+import pytest
+from pyreadpartitions import get_disk_partitions_info
+
+from diskvm import partition_fast
+from diskvm.errors import UnsupportedPartitionTableError
+
+
+def make_disk(partitions: list[tuple[int, int, int]], ebrs: dict[int, list[tuple[int, int, int]]] = None, size=64 * 512) -> bytes:
+    """
+    Build a disk image with an MBR containing the primary partitions (type, lba, sectors)
+    and optional EBRs (lba -> partition entries relative to the extended partition)
+    """
+    disk = bytearray(size)
+    for lba, entries in {0: partitions, **(ebrs or {})}.items():
+        for i, (part_type, part_lba, sectors) in enumerate(entries):
+            offset = lba * 512 + partition_fast.MBR_PARTITION_TABLE_OFFSET + i * partition_fast.MBR_PARTITION.size
+            partition_fast.MBR_PARTITION.pack_into(disk, offset, 0, b'\x00' * 3, part_type, b'\x00' * 3, part_lba, sectors)
+        disk[lba * 512 + 510:lba * 512 + 512] = partition_fast.MBR_SIGNATURE
+    return bytes(disk)
+
+
+def read_fallback(disk: bytes):
+    return partition_fast.add_fourth_mbr_partition(get_disk_partitions_info(io.BytesIO(disk)), disk)
+
+
+def partition_tuples(info):
+    return [(p.index, p.type, p.lba, p.sectors) for p in info.mbr.partitions]
+
+
+@pytest.mark.parametrize('partitions', [
+    [(0x83, 2048, 100)],
+    [(0x07, 2048, 100), (0x83, 4096, 100), (0x82, 8192, 100), (0x83, 16384, 100)],
+    [(0x07, 2048, 100), (0x00, 0, 0), (0x00, 0, 0), (0x83, 16384, 100)],
+])
+def test_mbr_primary_partitions_same_as_fallback(partitions):
+    disk = make_disk(partitions)
+    fast = partition_fast.parse_partition_table(disk[:partition_fast.LBA_SIZE * 34])
+    assert partition_tuples(fast) == partition_tuples(read_fallback(disk))
+    assert [(p.type, p.lba, p.sectors) for p in fast.mbr.partitions] == [p for p in partitions if p[0]]
+    assert fast.gpt is None
+
+
+def test_mbr_extended_partition_uses_fallback():
+    disk = make_disk([(0x07, 2048, 100), (0x05, 32, 20), (0x00, 0, 0), (0x83, 16384, 100)], ebrs={32: [(0x83, 1, 10)]})
+    with pytest.raises(UnsupportedPartitionTableError):
+        partition_fast.parse_partition_table(disk[:partition_fast.LBA_SIZE * 34])
+
+    partitions = partition_tuples(read_fallback(disk))
+    # Primary partitions including the 4th entry, followed by logical partitions
+    assert [index for index, _, _, _ in partitions] == [1, 2, 4, 5]
+    assert partitions[2] == (4, 0x83, 16384, 100)
+
+
+def test_no_mbr():
+    disk = bytes(34 * 512)
+    assert partition_fast.parse_partition_table(disk) == (None, None)
+    assert read_fallback(disk).mbr is None
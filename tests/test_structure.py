@@ -0,0 +1,42 @@
+import dataclasses
+
+from diskvm.structure import Structure, Uint8, Uint16, Uint32, Endian, bytes_field
+
+
+@dataclasses.dataclass()
+class EmptyStructure(Structure):
+    pass
+
+
+@dataclasses.dataclass()
+class SingleFieldStructure(Structure):
+    value: Uint32 = 0
+
+
+@dataclasses.dataclass()
+class BigEndianStructure(Structure):
+    endian = Endian.BIG
+
+    magic: bytes = bytes_field(size=4, default=b'TEST')
+    version: Uint16 = 1
+    flags: Uint8 = 0
+
+
+def test_pack_unpack_empty():
+    assert EmptyStructure.struct_size() == 0
+    assert EmptyStructure().pack() == b''
+    assert EmptyStructure.unpack(b'') == EmptyStructure()
+
+
+def test_pack_unpack_single_field():
+    data = SingleFieldStructure(value=Uint32(0x12345678)).pack()
+    assert data == b'\x78\x56\x34\x12'
+    assert SingleFieldStructure.unpack(data) == SingleFieldStructure(value=0x12345678)
+
+
+def test_pack_unpack_multiple_fields():
+    header = BigEndianStructure(version=Uint16(2), flags=Uint8(3))
+    data = header.pack()
+    assert data == b'TEST\x00\x02\x03'
+    assert BigEndianStructure.struct_size() == len(data)
+    assert BigEndianStructure.unpack(data) == header